@@ -1,19 +1,97 @@
-from .message_store import MessageStore
-from .message import Message
-from .message_metadata import MessageMetadata
-from .message_from_subscription import MessageFromSubscription
-from .projections.projection import Projection
+"""
+Exports are resolved lazily so that importing a lightweight class such as
+Message doesn't pull in the nats client modules. message_store.message and
+message_store.message_metadata can also be imported directly
+"""
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+# imported eagerly: the submodule has the same name as the logger it exports,
+# so a lazy lookup would be shadowed by the submodule once anything imports it
 from .message_store_logger import message_store_logger
-from .subscriptions.subscription import Subscription
-from .timeout_exception import TimeoutException
+
+if TYPE_CHECKING:
+    from .message_store import MessageStore
+    from .connection_pool import ConnectionPool
+    from .message import Message
+    from .message_metadata import MessageMetadata
+    from .message_from_subscription import MessageFromSubscription
+    from .projections.projection import Projection
+    from .projections.columnar_projection import ColumnarProjection
+    from .subscriptions.subscription import Subscription
+    from .subscriptions.idempotency_store import (
+        IdempotencyStore,
+        InMemoryIdempotencyStore,
+        JetStreamIdempotencyStore,
+    )
+    from .subscriptions.executor_handler import ExecutorHandler
+    from .subscriptions.subscription_manager import (
+        SubscriptionManager,
+        SubscriptionHealth,
+    )
+    from .timeout_exception import TimeoutException
+    from .circuit_breaker import CircuitBreaker
+    from .circuit_open_exception import CircuitOpenException
+    from .backends.backend import Backend, JetStreamBackend
+    from .backends.in_memory_backend import InMemoryBackend, InMemoryServer
+
+_lazy_exports = {
+    "MessageStore": ".message_store",
+    "ConnectionPool": ".connection_pool",
+    "Message": ".message",
+    "MessageMetadata": ".message_metadata",
+    "MessageFromSubscription": ".message_from_subscription",
+    "Projection": ".projections.projection",
+    "ColumnarProjection": ".projections.columnar_projection",
+    "Subscription": ".subscriptions.subscription",
+    "IdempotencyStore": ".subscriptions.idempotency_store",
+    "InMemoryIdempotencyStore": ".subscriptions.idempotency_store",
+    "JetStreamIdempotencyStore": ".subscriptions.idempotency_store",
+    "ExecutorHandler": ".subscriptions.executor_handler",
+    "SubscriptionManager": ".subscriptions.subscription_manager",
+    "SubscriptionHealth": ".subscriptions.subscription_manager",
+    "TimeoutException": ".timeout_exception",
+    "CircuitBreaker": ".circuit_breaker",
+    "CircuitOpenException": ".circuit_open_exception",
+    "Backend": ".backends.backend",
+    "JetStreamBackend": ".backends.backend",
+    "InMemoryBackend": ".backends.in_memory_backend",
+    "InMemoryServer": ".backends.in_memory_backend",
+}
 
 __all__ = [
     "MessageStore",
+    "ConnectionPool",
     "Message",
     "MessageMetadata",
     "MessageFromSubscription",
     "Projection",
+    "ColumnarProjection",
     "message_store_logger",
     "Subscription",
+    "IdempotencyStore",
+    "InMemoryIdempotencyStore",
+    "JetStreamIdempotencyStore",
+    "ExecutorHandler",
+    "SubscriptionManager",
+    "SubscriptionHealth",
     "TimeoutException",
+    "CircuitBreaker",
+    "CircuitOpenException",
+    "Backend",
+    "JetStreamBackend",
+    "InMemoryBackend",
+    "InMemoryServer",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _lazy_exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_lazy_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
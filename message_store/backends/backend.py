@@ -0,0 +1,112 @@
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Protocol
+
+from nats.aio.msg import Msg
+from nats.js.api import ConsumerInfo, PubAck, StreamInfo
+
+
+class PullSubscriptionBackend(Protocol):
+    """
+    The part of nats' JetStreamContext.PullSubscription used by Subscription
+    """
+
+    async def fetch(
+        self,
+        batch: int = 1,
+        timeout: Optional[float] = 5,
+        heartbeat: Optional[float] = None,
+    ) -> List[Msg]:
+        ...
+
+    @property
+    def pending_msgs(self) -> int:
+        ...
+
+    async def consumer_info(self) -> ConsumerInfo:
+        ...
+
+    async def unsubscribe(self) -> None:
+        ...
+
+
+class JetStreamBackend(Protocol):
+    """
+    The part of nats' JetStreamContext used by MessageStore, Fetch and Subscription
+    """
+
+    async def publish(
+        self,
+        subject: str,
+        payload: bytes = b"",
+        *,
+        timeout: Optional[float] = None,
+        stream: Optional[str] = None,
+        headers: Optional[Dict] = None,
+    ) -> PubAck:
+        ...
+
+    async def subscribe(self, subject: str, *, ordered_consumer: bool = False) -> Any:
+        ...
+
+    async def pull_subscribe(
+        self, subject: str, *, durable: Optional[str] = None
+    ) -> PullSubscriptionBackend:
+        ...
+
+    async def find_stream_name_by_subject(self, subject: str) -> str:
+        ...
+
+    async def add_stream(self, config: Any = None, **params: Any) -> StreamInfo:
+        ...
+
+    async def streams_info(self) -> List[StreamInfo]:
+        ...
+
+    async def delete_consumer(self, stream: str, consumer: str) -> bool:
+        ...
+
+    async def key_value(self, bucket: str) -> Any:
+        ...
+
+    async def create_key_value(self, config: Any = None, **params: Any) -> Any:
+        ...
+
+
+class Backend(Protocol):
+    """
+    The part of a nats connection (nats.aio.client.Client) used by MessageStore.
+    Any object implementing it, such as InMemoryBackend, can be given to MessageStore
+    or ConnectionPool in place of a nats connection
+    """
+
+    @property
+    def is_closed(self) -> bool:
+        ...
+
+    def jetstream(self) -> JetStreamBackend:
+        ...
+
+    async def subscribe(self, subject: str) -> Any:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+if TYPE_CHECKING:
+    from nats.aio.client import Client
+    from nats.js.client import JetStreamContext
+
+    # mypy fails here if the protocols stop matching nats-py, which would make
+    # MessageStore(nats_connection, ...) a type error for users
+    def _check_nats_client_is_a_backend(client: Client) -> Backend:
+        return client
+
+    def _check_nats_jetstream_is_a_jetstream_backend(
+        jetstream: JetStreamContext,
+    ) -> JetStreamBackend:
+        return jetstream
+
+    def _check_nats_pull_subscription_is_a_pull_subscription_backend(
+        pull_subscription: JetStreamContext.PullSubscription,
+    ) -> PullSubscriptionBackend:
+        return pull_subscription
@@ -0,0 +1,625 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, AsyncIterator, Deque, Dict, List, Optional, cast
+
+from nats.aio.msg import Msg
+from nats.errors import ConnectionClosedError, TimeoutError
+from nats.js import api
+import nats.js.errors
+
+
+class InMemoryServer:
+    """
+    State shared by all the InMemoryBackend connections to it: streams with their
+    messages and consumers, key-value buckets and core nats subscriptions.
+    Durable (pull) consumers track ack/nak/term, redeliver nak'ed messages right away
+    and messages that weren't acked within ack_wait_in_secs on the next fetch.
+    Ordered consumers replay the stream from the start and follow new messages
+    """
+
+    def __init__(
+        self, ack_wait_in_secs: float = 30, duplicate_window_in_secs: float = 120
+    ):
+        self.ack_wait_in_secs = ack_wait_in_secs
+        self.duplicate_window_in_secs = duplicate_window_in_secs
+        self.streams: Dict[str, "_Stream"] = {}
+        self.key_values: Dict[str, "InMemoryKeyValue"] = {}
+        self.core_subscriptions: List["_CoreSubscription"] = []
+        self._ephemeral_consumer_ids = itertools.count(1)
+
+    def next_ephemeral_consumer_name(self) -> str:
+        return f"ephemeral-{next(self._ephemeral_consumer_ids)}"
+
+    def find_stream_by_subject(self, subject: str) -> "_Stream":
+        for stream in self.streams.values():
+            if any(
+                subject_matches(stream_subject, subject)
+                for stream_subject in stream.config.subjects or []
+            ):
+                return stream
+        raise nats.js.errors.NotFoundError(
+            code=404, err_code=10059, description="stream not found"
+        )
+
+    def publish_to_core_subscriptions(
+        self, subject: str, data: bytes, headers: Optional[Dict[str, str]]
+    ) -> None:
+        for core_subscription in self.core_subscriptions:
+            if subject_matches(core_subscription.subject, subject):
+                core_subscription.deliver(InMemoryMsg(subject, data, headers))
+
+
+class InMemoryBackend:
+    """
+    In-process stand-in for a nats connection with JetStream, so MessageStore, Fetch
+    and Subscription can be tested and benchmarked without a nats server, e.g.:
+
+    message_store = MessageStore(InMemoryBackend(), "test", should_create_missing_streams=True)
+
+    Several backends can share an InMemoryServer to model a pool of connections
+    """
+
+    def __init__(self, server: Optional[InMemoryServer] = None):
+        self.server = server if server is not None else InMemoryServer()
+        self._is_closed = False
+
+    @property
+    def is_closed(self) -> bool:
+        return self._is_closed
+
+    def jetstream(self, **opts: Any) -> "InMemoryJetStream":
+        return InMemoryJetStream(self)
+
+    async def subscribe(self, subject: str) -> "_CoreSubscription":
+        self.ensure_is_open()
+        core_subscription = _CoreSubscription(self.server, subject)
+        self.server.core_subscriptions.append(core_subscription)
+        return core_subscription
+
+    async def publish(
+        self, subject: str, payload: bytes = b"", headers: Optional[Dict] = None
+    ) -> None:
+        self.ensure_is_open()
+        self.server.publish_to_core_subscriptions(subject, payload, headers)
+
+    async def close(self) -> None:
+        self._is_closed = True
+
+    def ensure_is_open(self) -> None:
+        if self._is_closed:
+            raise ConnectionClosedError
+
+
+class InMemoryJetStream:
+    def __init__(self, backend: InMemoryBackend):
+        self._backend = backend
+        self._server = backend.server
+
+    async def publish(
+        self,
+        subject: str,
+        payload: bytes = b"",
+        timeout: Optional[float] = None,
+        stream: Optional[str] = None,
+        headers: Optional[Dict] = None,
+    ) -> api.PubAck:
+        self._backend.ensure_is_open()
+        try:
+            target_stream = self._server.find_stream_by_subject(subject)
+        except nats.js.errors.NotFoundError:
+            raise nats.js.errors.NoStreamResponseError from None
+        if stream is not None and target_stream.name != stream:
+            raise nats.js.errors.BadRequestError(
+                code=400, err_code=10060, description="expected stream does not match"
+            )
+        pub_ack = target_stream.append(subject, payload, headers)
+        if not pub_ack.duplicate:
+            self._server.publish_to_core_subscriptions(subject, payload, headers)
+        return pub_ack
+
+    async def find_stream_name_by_subject(self, subject: str) -> str:
+        self._backend.ensure_is_open()
+        return self._server.find_stream_by_subject(subject).name
+
+    async def add_stream(
+        self, config: Optional[api.StreamConfig] = None, **params: Any
+    ) -> api.StreamInfo:
+        self._backend.ensure_is_open()
+        if config is None:
+            config = api.StreamConfig(**params)
+        else:
+            config = config.evolve(**params)
+        if config.name is None:
+            raise ValueError("nats: stream name is required")
+        if config.name in self._server.streams:
+            raise nats.js.errors.BadRequestError(
+                code=400, err_code=10058, description="stream name already in use"
+            )
+        stream = _Stream(self._server, config.name, config)
+        self._server.streams[stream.name] = stream
+        return stream.info()
+
+    async def stream_info(self, name: str) -> api.StreamInfo:
+        self._backend.ensure_is_open()
+        return self._get_stream(name).info()
+
+    async def streams_info(self, offset: int = 0) -> List[api.StreamInfo]:
+        self._backend.ensure_is_open()
+        return [stream.info() for stream in self._server.streams.values()][offset:]
+
+    async def delete_stream(self, name: str) -> bool:
+        self._backend.ensure_is_open()
+        self._get_stream(name).close()
+        del self._server.streams[name]
+        return True
+
+    async def delete_consumer(self, stream: str, consumer: str) -> bool:
+        self._backend.ensure_is_open()
+        target_stream = self._get_stream(stream)
+        if consumer not in target_stream.consumers:
+            raise nats.js.errors.NotFoundError(
+                code=404, err_code=10014, description="consumer not found"
+            )
+        target_stream.consumers.pop(consumer).close()
+        return True
+
+    async def subscribe(
+        self, subject: str, ordered_consumer: bool = False, **kwargs: Any
+    ) -> "_OrderedSubscription":
+        self._backend.ensure_is_open()
+        if not ordered_consumer:
+            raise ValueError(
+                "InMemoryJetStream only supports ordered push consumers (ordered_consumer=True), use pull_subscribe for durable ones"
+            )
+        stream = self._server.find_stream_by_subject(subject)
+        consumer = _Consumer(
+            stream, self._server.next_ephemeral_consumer_name(), subject, is_ordered=True
+        )
+        stream.consumers[consumer.name] = consumer
+        return _OrderedSubscription(self._backend, consumer)
+
+    async def pull_subscribe(
+        self,
+        subject: str,
+        durable: Optional[str] = None,
+        stream: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "_PullSubscription":
+        self._backend.ensure_is_open()
+        target_stream = (
+            self._get_stream(stream)
+            if stream is not None
+            else self._server.find_stream_by_subject(subject)
+        )
+        name = durable if durable is not None else self._server.next_ephemeral_consumer_name()
+        if name not in target_stream.consumers:
+            target_stream.consumers[name] = _Consumer(target_stream, name, subject)
+        return _PullSubscription(self._backend, target_stream.consumers[name])
+
+    async def key_value(self, bucket: str) -> "InMemoryKeyValue":
+        self._backend.ensure_is_open()
+        if bucket not in self._server.key_values:
+            raise nats.js.errors.BucketNotFoundError
+        return self._server.key_values[bucket]
+
+    async def create_key_value(
+        self, config: Optional[api.KeyValueConfig] = None, **params: Any
+    ) -> "InMemoryKeyValue":
+        self._backend.ensure_is_open()
+        if config is None:
+            config = api.KeyValueConfig(bucket=params["bucket"])
+        config = config.evolve(**params)
+        if config.bucket not in self._server.key_values:
+            self._server.key_values[config.bucket] = InMemoryKeyValue(
+                config.bucket, config.ttl
+            )
+        return self._server.key_values[config.bucket]
+
+    def _get_stream(self, name: str) -> "_Stream":
+        if name not in self._server.streams:
+            raise nats.js.errors.NotFoundError(
+                code=404, err_code=10059, description="stream not found"
+            )
+        return self._server.streams[name]
+
+
+class InMemoryKeyValue:
+    class Entry:
+        def __init__(self, bucket: str, key: str, value: bytes, revision: int):
+            self.bucket = bucket
+            self.key = key
+            self.value = value
+            self.revision = revision
+
+    def __init__(self, bucket: str, ttl_in_secs: Optional[float]):
+        self._bucket = bucket
+        self._ttl_in_secs = ttl_in_secs
+        self._entries: Dict[str, tuple] = {}
+        self._revisions = itertools.count(1)
+
+    async def get(self, key: str) -> "InMemoryKeyValue.Entry":
+        if key not in self._entries:
+            raise nats.js.errors.KeyNotFoundError
+        entry, stored_at = self._entries[key]
+        if self._ttl_in_secs and time.monotonic() - stored_at > self._ttl_in_secs:
+            del self._entries[key]
+            raise nats.js.errors.KeyNotFoundError
+        return entry
+
+    async def put(self, key: str, value: bytes) -> int:
+        revision = next(self._revisions)
+        self._entries[key] = (
+            InMemoryKeyValue.Entry(self._bucket, key, value, revision),
+            time.monotonic(),
+        )
+        return revision
+
+    async def delete(self, key: str) -> bool:
+        self._entries.pop(key, None)
+        return True
+
+
+class InMemoryMsg(Msg):
+    """
+    A nats Msg without a client: acks, naks and terms go straight to the in-memory
+    consumer that delivered it
+    """
+
+    def __init__(
+        self,
+        subject: str,
+        data: bytes,
+        headers: Optional[Dict[str, str]] = None,
+        metadata: Optional[Msg.Metadata] = None,
+        consumer: Optional["_Consumer"] = None,
+    ):
+        super().__init__(
+            _client=cast(Any, None),
+            subject=subject,
+            data=data,
+            headers=headers,
+            _metadata=metadata,
+        )
+        self._consumer = consumer
+
+    @property
+    def metadata(self) -> Msg.Metadata:
+        if self._metadata is None:
+            raise nats.errors.NotJSMessageError
+        return self._metadata
+
+    async def ack(self) -> None:
+        if self._consumer is not None:
+            self._consumer.ack(self.metadata.sequence.stream)
+
+    async def nak(self, delay: Optional[float] = None) -> None:
+        if self._consumer is not None:
+            self._consumer.nak(self.metadata.sequence.stream, delay)
+
+    async def term(self) -> None:
+        if self._consumer is not None:
+            self._consumer.ack(self.metadata.sequence.stream)
+
+    async def in_progress(self) -> None:
+        if self._consumer is not None:
+            self._consumer.in_progress(self.metadata.sequence.stream)
+
+
+class _StoredMessage:
+    def __init__(
+        self,
+        seq: int,
+        subject: str,
+        data: bytes,
+        headers: Optional[Dict[str, str]],
+    ):
+        self.seq = seq
+        self.subject = subject
+        self.data = data
+        self.headers = headers
+        self.timestamp = datetime.now(timezone.utc)
+
+
+class _Stream:
+    def __init__(self, server: InMemoryServer, name: str, config: api.StreamConfig):
+        self._server = server
+        self.name = name
+        self.config = config
+        self.messages: List[_StoredMessage] = []
+        self.consumers: Dict[str, _Consumer] = {}
+        self._published_msg_ids: Dict[str, tuple] = {}
+
+    def append(
+        self, subject: str, data: bytes, headers: Optional[Dict[str, str]]
+    ) -> api.PubAck:
+        max_msg_size = self.config.max_msg_size
+        if max_msg_size is not None and max_msg_size >= 0 and len(data) > max_msg_size:
+            raise nats.js.errors.BadRequestError(
+                code=400, err_code=10054, description="message size exceeds maximum allowed"
+            )
+        msg_id = headers.get("Nats-Msg-Id") if headers else None
+        if msg_id is not None and msg_id in self._published_msg_ids:
+            seq, published_at = self._published_msg_ids[msg_id]
+            if time.monotonic() - published_at <= self._server.duplicate_window_in_secs:
+                return api.PubAck(stream=self.name, seq=seq, duplicate=True)
+        seq = len(self.messages) + 1
+        self.messages.append(_StoredMessage(seq, subject, data, headers))
+        if msg_id is not None:
+            self._published_msg_ids[msg_id] = (seq, time.monotonic())
+        for consumer in self.consumers.values():
+            if subject_matches(consumer.filter_subject, subject):
+                consumer.notify()
+        return api.PubAck(stream=self.name, seq=seq, duplicate=False)
+
+    def info(self) -> api.StreamInfo:
+        return api.StreamInfo(
+            config=self.config,
+            state=api.StreamState(
+                messages=len(self.messages),
+                bytes=sum(len(message.data) for message in self.messages),
+                first_seq=1 if self.messages else 0,
+                last_seq=len(self.messages),
+                consumer_count=len(self.consumers),
+            ),
+        )
+
+    def close(self) -> None:
+        for consumer in self.consumers.values():
+            consumer.close()
+
+
+class _Consumer:
+    def __init__(
+        self, stream: _Stream, name: str, filter_subject: str, is_ordered: bool = False
+    ):
+        self.stream = stream
+        self.name = name
+        self.filter_subject = filter_subject
+        self.is_ordered = is_ordered
+        self.is_closed = False
+        self._server = stream._server
+        self._next_stream_index = 0
+        self._delivered_consumer_seq = 0
+        self._last_delivered_stream_seq = 0
+        self._num_delivered: Dict[int, int] = {}
+        self._ack_deadlines: Dict[int, float] = {}
+        self._redeliveries: Deque[int] = deque()
+        self._has_news = asyncio.Event()
+
+    def take(self, batch: int) -> List[InMemoryMsg]:
+        """ Redeliveries (nak'ed or past their ack wait) first, then new messages """
+        self._queue_expired_for_redelivery()
+        messages: List[InMemoryMsg] = []
+        while len(messages) < batch and self._redeliveries:
+            seq = self._redeliveries.popleft()
+            if seq in self._ack_deadlines:
+                messages.append(self._deliver(self.stream.messages[seq - 1]))
+        while len(messages) < batch:
+            stored_message = self._next_new_message()
+            if stored_message is None:
+                break
+            messages.append(self._deliver(stored_message))
+        self._has_news.clear()
+        return messages
+
+    async def wait_for_news(self, timeout: float) -> None:
+        if self._ack_deadlines:
+            timeout = min(
+                timeout, max(0, min(self._ack_deadlines.values()) - time.monotonic())
+            )
+        try:
+            await asyncio.wait_for(self._has_news.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def notify(self) -> None:
+        self._has_news.set()
+
+    def ack(self, seq: int) -> None:
+        self._ack_deadlines.pop(seq, None)
+
+    def nak(self, seq: int, delay: Optional[float] = None) -> None:
+        """ Redelivers right away, or once delay (in seconds) has passed like nats' NAK with a delay """
+        if seq not in self._ack_deadlines:
+            return
+        if delay:
+            self._ack_deadlines[seq] = time.monotonic() + delay
+            self.notify()
+            return
+        self._ack_deadlines[seq] = time.monotonic()
+        self._redeliveries.append(seq)
+        self.notify()
+
+    def in_progress(self, seq: int) -> None:
+        if seq in self._ack_deadlines:
+            self._ack_deadlines[seq] = time.monotonic() + self._server.ack_wait_in_secs
+
+    def info(self) -> api.ConsumerInfo:
+        return api.ConsumerInfo(
+            name=self.name,
+            stream_name=self.stream.name,
+            config=api.ConsumerConfig(
+                name=self.name,
+                durable_name=None if self.is_ordered else self.name,
+                filter_subject=self.filter_subject,
+            ),
+            delivered=api.SequenceInfo(
+                consumer_seq=self._delivered_consumer_seq,
+                stream_seq=self._last_delivered_stream_seq,
+            ),
+            num_ack_pending=len(self._ack_deadlines),
+            num_redelivered=sum(1 for count in self._num_delivered.values() if count > 1),
+            num_pending=sum(
+                1
+                for stored_message in self.stream.messages[self._next_stream_index :]
+                if subject_matches(self.filter_subject, stored_message.subject)
+            ),
+        )
+
+    def close(self) -> None:
+        self.is_closed = True
+        self.notify()
+
+    def _next_new_message(self) -> Optional[_StoredMessage]:
+        while self._next_stream_index < len(self.stream.messages):
+            stored_message = self.stream.messages[self._next_stream_index]
+            self._next_stream_index += 1
+            if subject_matches(self.filter_subject, stored_message.subject):
+                return stored_message
+        return None
+
+    def _queue_expired_for_redelivery(self) -> None:
+        now = time.monotonic()
+        for seq, deadline in self._ack_deadlines.items():
+            if deadline <= now and seq not in self._redeliveries:
+                self._redeliveries.append(seq)
+
+    def _deliver(self, stored_message: _StoredMessage) -> InMemoryMsg:
+        self._delivered_consumer_seq += 1
+        self._last_delivered_stream_seq = max(
+            self._last_delivered_stream_seq, stored_message.seq
+        )
+        num_delivered = self._num_delivered.get(stored_message.seq, 0) + 1
+        if not self.is_ordered:
+            self._num_delivered[stored_message.seq] = num_delivered
+            self._ack_deadlines[stored_message.seq] = (
+                time.monotonic() + self._server.ack_wait_in_secs
+            )
+        return InMemoryMsg(
+            subject=stored_message.subject,
+            data=stored_message.data,
+            headers=stored_message.headers,
+            metadata=Msg.Metadata(
+                sequence=Msg.Metadata.SequencePair(
+                    consumer=self._delivered_consumer_seq, stream=stored_message.seq
+                ),
+                num_pending=0,
+                num_delivered=num_delivered,
+                timestamp=stored_message.timestamp,
+                stream=self.stream.name,
+                consumer=self.name,
+            ),
+            consumer=None if self.is_ordered else self,
+        )
+
+
+class _PullSubscription:
+    def __init__(self, backend: InMemoryBackend, consumer: _Consumer):
+        self._backend = backend
+        self._consumer = consumer
+
+    @property
+    def pending_msgs(self) -> int:
+        return 0
+
+    async def fetch(
+        self,
+        batch: int = 1,
+        timeout: Optional[float] = 5,
+        heartbeat: Optional[float] = None,
+    ) -> List[Msg]:
+        if batch < 1:
+            raise ValueError("nats: invalid batch size")
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            self._backend.ensure_is_open()
+            if self._consumer.is_closed:
+                raise nats.js.errors.NotFoundError(
+                    code=404, err_code=10014, description="consumer not found"
+                )
+            messages: List[Msg] = list(self._consumer.take(batch))
+            if messages:
+                return messages
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            await self._consumer.wait_for_news(remaining)
+
+    async def consumer_info(self) -> api.ConsumerInfo:
+        self._backend.ensure_is_open()
+        return self._consumer.info()
+
+    async def unsubscribe(self) -> None:
+        pass
+
+
+class _OrderedSubscription:
+    def __init__(self, backend: InMemoryBackend, consumer: _Consumer):
+        self._backend = backend
+        self._consumer = consumer
+        self._is_unsubscribed = False
+
+    @property
+    def messages(self) -> AsyncIterator[InMemoryMsg]:
+        return self._iterate_messages()
+
+    async def _iterate_messages(self) -> AsyncIterator[InMemoryMsg]:
+        while not self._is_unsubscribed and not self._consumer.is_closed:
+            self._backend.ensure_is_open()
+            messages = self._consumer.take(1)
+            if messages:
+                yield messages[0]
+            else:
+                await self._consumer.wait_for_news(timeout=1)
+
+    async def consumer_info(self) -> api.ConsumerInfo:
+        self._backend.ensure_is_open()
+        return self._consumer.info()
+
+    async def unsubscribe(self) -> None:
+        self._is_unsubscribed = True
+        self._consumer.notify()
+
+
+class _CoreSubscription:
+    def __init__(self, server: InMemoryServer, subject: str):
+        self._server = server
+        self.subject = subject
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def deliver(self, message: InMemoryMsg) -> None:
+        self._queue.put_nowait(message)
+
+    @property
+    def messages(self) -> AsyncIterator[InMemoryMsg]:
+        return self._iterate_messages()
+
+    async def _iterate_messages(self) -> AsyncIterator[InMemoryMsg]:
+        while True:
+            message = await self._queue.get()
+            if message is None:
+                return
+            yield message
+
+    async def unsubscribe(self) -> None:
+        if self in self._server.core_subscriptions:
+            self._server.core_subscriptions.remove(self)
+            self._queue.put_nowait(None)
+
+
+def subject_matches(pattern: str, subject: str) -> bool:
+    """
+    Whether subject is covered by pattern, which can use the * (one token) and
+    > (one or more trailing tokens) nats wildcards
+    """
+    pattern_tokens = pattern.split(".")
+    subject_tokens = subject.split(".")
+    for index, pattern_token in enumerate(pattern_tokens):
+        if pattern_token == ">":
+            return len(subject_tokens) > index
+        if index >= len(subject_tokens):
+            return False
+        if pattern_token != "*" and pattern_token != subject_tokens[index]:
+            return False
+    return len(pattern_tokens) == len(subject_tokens)
+
+
+if TYPE_CHECKING:
+    from .backend import Backend
+
+    # mypy fails here if InMemoryBackend stops implementing the Backend protocol
+    def _check_in_memory_backend_is_a_backend(backend: InMemoryBackend) -> Backend:
+        return backend
@@ -0,0 +1,85 @@
+import time
+
+from .circuit_open_exception import CircuitOpenException
+from .message_store_logger import message_store_logger
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while the cluster is known to be unavailable.
+    After failure_threshold consecutive retriable failures the circuit opens and calls
+    raise CircuitOpenException straight away. Once recovery_timeout_in_seconds has passed
+    the circuit is half open: up to max_concurrent_probes calls are let through, a
+    successful call closes the circuit and a failing probe opens it again.
+    A MessageStore shares one breaker between all its publishes and fetches
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_timeout_in_seconds: float = 10,
+        max_concurrent_probes: int = 1,
+    ):
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout_in_seconds = recovery_timeout_in_seconds
+        self._max_concurrent_probes = max_concurrent_probes
+        self._consecutive_failures = 0
+        self._opened_at: float | None = None
+        self._probes_in_flight = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return CircuitBreaker.CLOSED
+        if time.monotonic() - self._opened_at < self._recovery_timeout_in_seconds:
+            return CircuitBreaker.OPEN
+        return CircuitBreaker.HALF_OPEN
+
+    def before_call(self) -> bool:
+        """
+        Raises CircuitOpenException if the call must not be attempted.
+        Returns whether the call is a recovery probe, to be passed back to record_*
+        """
+        state = self.state
+        if state == CircuitBreaker.CLOSED:
+            return False
+        if (
+            state == CircuitBreaker.OPEN
+            or self._probes_in_flight >= self._max_concurrent_probes
+        ):
+            raise CircuitOpenException(
+                f"Circuit is open after {self._consecutive_failures} consecutive failures, not attempting the call"
+            )
+        self._probes_in_flight += 1
+        return True
+
+    def record_success(self, is_probe: bool) -> None:
+        self._release_probe(is_probe)
+        if self._opened_at is not None:
+            message_store_logger.info("Circuit closed, calls are going through again")
+            self._opened_at = None
+        self._consecutive_failures = 0
+
+    def record_failure(self, is_probe: bool) -> None:
+        self._release_probe(is_probe)
+        self._consecutive_failures += 1
+        if is_probe or (
+            self._opened_at is None
+            and self._consecutive_failures >= self._failure_threshold
+        ):
+            message_store_logger.warning(
+                f"Circuit opened after {self._consecutive_failures} consecutive failures, failing calls fast for {self._recovery_timeout_in_seconds} seconds"
+            )
+            self._opened_at = time.monotonic()
+
+    def record_abandoned(self, is_probe: bool) -> None:
+        """ For calls that neither succeeded nor failed, e.g. because they were cancelled """
+        self._release_probe(is_probe)
+
+    def _release_probe(self, is_probe: bool) -> None:
+        if is_probe:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
@@ -0,0 +1,115 @@
+import itertools
+from typing import Any, List, Sequence
+
+import nats
+
+from .backends.backend import Backend, JetStreamBackend
+
+
+class ConnectionPool:
+    """
+    A small pool of nats connections a MessageStore can spread its work across.
+    Each subscription is pinned to the non-primary connection with the fewest
+    subscriptions, and publishes, fetches and wait_for calls are distributed
+    round-robin over the open connections that have no subscription pinned to them,
+    so a busy consumer doesn't share its socket and read loop with unrelated
+    publishes. Only when every open connection has subscriptions do they share.
+    The first connection is the primary one, used for stream management and never
+    given to a subscription while another connection is open.
+    """
+
+    def __init__(self, connections: Sequence[Backend]):
+        if len(connections) == 0:
+            raise ValueError("ConnectionPool requires at least one nats connection")
+        self._connections = list(connections)
+        self._jetstreams = [connection.jetstream() for connection in connections]
+        self._subscriptions_per_connection = [0] * len(connections)
+        self._round_robin = itertools.cycle(range(len(connections)))
+
+    @staticmethod
+    async def connect(size: int, *args: Any, **kwargs: Any) -> "ConnectionPool":
+        """
+        Opens size connections to nats, all of them using the same arguments
+        nats.connect would take (e.g. servers, credentials)
+        """
+        if size < 1:
+            raise ValueError("ConnectionPool size must be at least 1")
+        connections = []
+        try:
+            for _ in range(size):
+                connections.append(await nats.connect(*args, **kwargs))
+        except Exception:
+            for connection in connections:
+                await connection.close()
+            raise
+        return ConnectionPool(connections)
+
+    @property
+    def connections(self) -> List[Backend]:
+        return list(self._connections)
+
+    @property
+    def primary_connection(self) -> Backend:
+        return self._connections[0]
+
+    @property
+    def primary_jetstream(self) -> JetStreamBackend:
+        return self._jetstreams[0]
+
+    def next_connection(self) -> Backend:
+        return self._connections[self._next_index()]
+
+    def next_jetstream(self) -> JetStreamBackend:
+        return self._jetstreams[self._next_index()]
+
+    def acquire_connection_for_subscription(self) -> tuple[Backend, JetStreamBackend]:
+        """
+        Returns the open connection (and its jetstream context) with the fewest
+        subscriptions pinned to it. When the pool has more than one connection
+        the primary one is only used for subscriptions if all others are closed
+        """
+        candidates = [
+            index
+            for index in range(len(self._connections))
+            if not self._connections[index].is_closed
+        ] or list(range(len(self._connections)))
+        if len(candidates) > 1 and 0 in candidates:
+            candidates.remove(0)
+        index = min(candidates, key=lambda i: self._subscriptions_per_connection[i])
+        self._subscriptions_per_connection[index] += 1
+        return self._connections[index], self._jetstreams[index]
+
+    def release_connection_for_subscription(self, connection: Backend) -> None:
+        """
+        Undoes acquire_connection_for_subscription once the subscription pinned to
+        connection stops, so new subscriptions go to the least used connections
+        """
+        for index, pooled_connection in enumerate(self._connections):
+            if pooled_connection is connection:
+                if self._subscriptions_per_connection[index] > 0:
+                    self._subscriptions_per_connection[index] -= 1
+                return
+
+    async def close(self) -> None:
+        for connection in self._connections:
+            if not connection.is_closed:
+                await connection.close()
+
+    def _next_index(self) -> int:
+        open_indexes = [
+            index
+            for index in range(len(self._connections))
+            if not self._connections[index].is_closed
+        ]
+        candidates = [
+            index
+            for index in open_indexes
+            if self._subscriptions_per_connection[index] == 0
+        ] or open_indexes
+        if len(candidates) == 0:
+            return next(self._round_robin)
+        # the cycle visits every index within len(connections) steps
+        while True:
+            index = next(self._round_robin)
+            if index in candidates:
+                return index
@@ -1,11 +1,12 @@
 from datetime import datetime
 import json
-from typing import Optional, Dict, Any
-
-from nats.aio.msg import Msg
+from typing import TYPE_CHECKING, Optional, Dict, Any
 
 from .message_metadata import MessageMetadata
 
+if TYPE_CHECKING:
+    from nats.aio.msg import Msg
+
 
 class MessageFromSubscription:
     def __init__(
@@ -51,7 +52,7 @@ class MessageFromSubscription:
 
     @staticmethod
     def create_from_js_message(
-        prefix: str, message: Msg, max_number_of_redeliveries: Optional[int] = None
+        prefix: str, message: "Msg", max_number_of_redeliveries: Optional[int] = None
     ):
         parsed_message_data: dict = json.loads(message.data.decode())
         return MessageFromSubscription(
@@ -68,5 +69,32 @@ class MessageFromSubscription:
             else None,  # it might actually go over the max_number_of_redelivereis because of timeouts
         )
 
+    def to_compact(self) -> tuple:
+        """ Picklable tuple form of the message, e.g. to hand it to a process pool worker """
+        return (
+            self.type,
+            self.data,
+            self.seq,
+            self.subject,
+            self.timestamp,
+            self.metadata.to_dict() if self.metadata is not None else None,
+            self.is_last_attempt,
+        )
+
+    @staticmethod
+    def create_from_compact(compact_message: tuple):
+        type, data, seq, subject, timestamp, metadata, is_last_attempt = compact_message
+        return MessageFromSubscription(
+            type=type,
+            data=data,
+            seq=seq,
+            subject=subject,
+            timestamp=timestamp,
+            metadata=MessageMetadata.create_from_dict(dict(metadata))
+            if metadata is not None
+            else None,
+            is_last_attempt=is_last_attempt,
+        )
+
     def __repr__(self):
         return str(self.to_dict())
@@ -1,17 +1,22 @@
 import asyncio
 import json
-from typing import Optional, Dict, Callable
+from typing import Optional, Dict, Callable, Union
+from concurrent.futures import Executor
 
-from nats.aio.client import Client
 import nats.errors
 from nats.js.api import PubAck
 import nats.js.errors
 
+from .backends.backend import Backend
+from .circuit_breaker import CircuitBreaker
+from .connection_pool import ConnectionPool
 from .message import Message
 from .projections.fetch import Fetch
 from .projections.projection import Projection
 from .message_from_subscription import MessageFromSubscription
 from .subscriptions.subscription import Subscription
+from .subscriptions.idempotency_store import IdempotencyStore
+from .subscriptions.subscription_manager import SubscriptionManager
 from .message_store_logger import message_store_logger
 from .timeout_exception import TimeoutException
 from .retry_with_exponential_backoff import retry_with_exponential_backoff
@@ -20,17 +25,38 @@ from .retry_with_exponential_backoff import retry_with_exponential_backoff
 class MessageStore:
     def __init__(
         self,
-        nats_connection: Client,
+        nats_connection: Union[Backend, ConnectionPool],
         prefix: str,
         should_create_missing_streams: bool = False,
+        circuit_breaker: Optional[CircuitBreaker] = None,
     ):
+        """
+        nats_connection can either be a single nats connection (or any other Backend,
+        e.g. InMemoryBackend) or a ConnectionPool.
+        With a pool, each subscription is pinned to the non-primary connection with
+        the fewest subscriptions (released again when the subscription stops), and
+        publishes and fetches are spread across the connections no subscription is
+        pinned to, which always includes the primary one.
+        Publishes and fetches share a circuit_breaker (a default one is created if not
+        provided) so they fail fast while JetStream is unavailable
+        """
         if prefix.endswith("."):
             prefix = prefix[:-1]
-        self._nats_connection = nats_connection
-        self._jetstream = nats_connection.jetstream()
+        self._connection_pool = (
+            nats_connection
+            if isinstance(nats_connection, ConnectionPool)
+            else ConnectionPool([nats_connection])
+        )
+        self._nats_connection = self._connection_pool.primary_connection
+        self._jetstream = self._connection_pool.primary_jetstream
         self._should_create_missing_streams = should_create_missing_streams
         self._nats_subject_prefix = f"{prefix}." if prefix != "" else ""
         self._nats_stream_prefix = f"{prefix}-" if prefix != "" else ""
+        self._subscriptions: list[Subscription] = []
+        self._subscription_managers: list[SubscriptionManager] = []
+        self._circuit_breaker = (
+            circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        )
 
     async def ensure_stream(
         self,
@@ -95,7 +121,7 @@ class MessageStore:
             headers = {"Nats-Msg-Id": msg_id}
 
         return await retry_with_exponential_backoff(
-            lambda: self._jetstream.publish(
+            lambda: self._connection_pool.next_jetstream().publish(
                 f"{self._nats_subject_prefix}{subject}",
                 json.dumps(message.to_dict()).encode("utf8"),
                 headers=headers,
@@ -105,15 +131,30 @@ class MessageStore:
             is_retriable=lambda e: isinstance(e, nats.js.errors.NoStreamResponseError)
             or (hasattr(e, "code") and e.code == 503),
             initial_backoff_time_in_seconds=0.25,
+            circuit_breaker=self._circuit_breaker,
         )
 
-    async def fetch(self, subject: str, projection: Projection):
-        fetcher = Fetch(self._jetstream, self._nats_subject_prefix)
-
+    async def fetch(
+        self,
+        subject: str,
+        projection: Projection,
+        deadline_in_seconds: Optional[float] = 30,
+    ):
+        """
+        Runs the projection over all the messages in the subject (automatically prefixed
+        by the prefix provided to the ctor) and returns its result.
+        Failed attempts are retried with jittered exponential backoff, but no retry is
+        started that would finish waiting after deadline_in_seconds. The deadline
+        never cuts short an attempt in progress, so long replays aren't limited by it
+        """
         return await retry_with_exponential_backoff(
-            lambda: fetcher.fetch(subject, projection),
+            lambda: Fetch(
+                self._connection_pool.next_jetstream(), self._nats_subject_prefix
+            ).fetch(subject, projection),
             max_retries=5,
             initial_backoff_time_in_seconds=5,
+            deadline_in_seconds=deadline_in_seconds,
+            circuit_breaker=self._circuit_breaker,
             is_retriable=lambda e: isinstance(e, nats.errors.TimeoutError)
             or isinstance(e, asyncio.TimeoutError)
             or isinstance(e, nats.js.errors.NoStreamResponseError)
@@ -135,10 +176,24 @@ class MessageStore:
         handlers: dict[str, Callable[[MessageFromSubscription], None]],
         max_number_of_retries: int = 3,
         dead_letter_subject: Optional[str] = None,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        executor: Optional[Executor] = None,
     ) -> Subscription:
-        return Subscription(
-            self._nats_connection,
-            self._jetstream,
+        """
+        Creates a durable subscription, call start() on it to start handling messages.
+        When an idempotency_store is provided, messages it has already seen (by
+        Nats-Msg-Id or stream sequence) are acked without calling their handler.
+        When an executor (thread or process pool) is provided, synchronous handlers run
+        in it instead of blocking the event loop. To offload only some handlers wrap
+        them in ExecutorHandler instead
+        """
+        (
+            nats_connection,
+            jetstream,
+        ) = self._connection_pool.acquire_connection_for_subscription()
+        subscription = Subscription(
+            nats_connection,
+            jetstream,
             self._nats_subject_prefix,
             subject,
             consumer_name,
@@ -149,7 +204,78 @@ class MessageStore:
                 if dead_letter_subject is not None
                 else None
             ),
+            idempotency_store=idempotency_store,
+            executor=executor,
+            release_connection=lambda: self._connection_pool.release_connection_for_subscription(
+                nats_connection
+            ),
         )
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def create_subscription_manager(
+        self,
+        max_concurrency: int = 10,
+        max_in_flight_bytes: int = 2**26,  # 64MB
+        poll_timeout_in_secs: float = 0.5,
+        max_idle_poll_interval_in_secs: float = 5,
+        max_message_size_in_bytes: int = 2**22,  # 4MB
+    ) -> SubscriptionManager:
+        """
+        Creates a SubscriptionManager to run many subscriptions (created with
+        create_subscription and added to it instead of being started) under a
+        single scheduler with a shared concurrency and memory budget
+        """
+        subscription_manager = SubscriptionManager(
+            max_concurrency=max_concurrency,
+            max_in_flight_bytes=max_in_flight_bytes,
+            poll_timeout_in_secs=poll_timeout_in_secs,
+            max_idle_poll_interval_in_secs=max_idle_poll_interval_in_secs,
+            max_message_size_in_bytes=max_message_size_in_bytes,
+        )
+        self._subscription_managers.append(subscription_manager)
+        return subscription_manager
+
+    async def close(
+        self,
+        drain_timeout_in_secs: Optional[float] = 10,
+        close_connections: bool = False,
+    ) -> None:
+        """
+        Drains all subscriptions (and subscription managers) created by this message store in parallel: they stop
+        pulling right away and get up to drain_timeout_in_secs to finish the messages
+        they are handling, after which those are nak'ed for immediate redelivery.
+        If close_connections is True the nats connection(s) are closed afterwards
+        """
+        managed_subscriptions = {
+            id(subscription)
+            for subscription_manager in self._subscription_managers
+            for subscription in subscription_manager.subscriptions
+        }
+        subscriptions: list[Union[Subscription, SubscriptionManager]] = [
+            *self._subscription_managers,
+            *[
+                subscription
+                for subscription in self._subscriptions
+                if id(subscription) not in managed_subscriptions
+            ],
+        ]
+        self._subscriptions = []
+        self._subscription_managers = []
+        results = await asyncio.gather(
+            *[
+                subscription.stop(drain_timeout_in_secs=drain_timeout_in_secs)
+                for subscription in subscriptions
+            ],
+            return_exceptions=True,
+        )
+        for subscription, result in zip(subscriptions, results):
+            if isinstance(result, BaseException):
+                message_store_logger.warning(
+                    f"Failed to stop {type(subscription).__name__}: {type(result).__name__} {result}"
+                )
+        if close_connections:
+            await self._connection_pool.close()
 
     async def wait_for(
         self, subject: str, predicate: Callable[[Message], bool], timeout: int = 5
@@ -158,7 +284,7 @@ class MessageStore:
         Waits for a message (event/command) on the subject (automatically prefixed by the prefix provided to the ctor)
         that matches the predicate. Returns the message if found, otherwise raises TimeoutException
         """
-        subscription = await self._nats_connection.subscribe(
+        subscription = await self._connection_pool.next_connection().subscribe(
             f"{self._nats_subject_prefix}{subject}"
         )
 
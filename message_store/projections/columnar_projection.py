@@ -0,0 +1,114 @@
+import json
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, TypeVar
+
+from .projection import Projection
+from ..message_from_subscription import MessageFromSubscription
+
+if TYPE_CHECKING:
+    from nats.aio.msg import Msg
+
+T = TypeVar("T")
+
+_ARRAY_BACKENDS = ("numpy", "arrow")
+
+
+class ColumnarProjection(Projection[T]):
+    """
+    Projection for aggregating numeric fields over long histories.
+    Instead of calling a handler per message, the values of the selected data fields
+    of every message of the given type are accumulated into columns and handed to the
+    reducer in batches of up to batch_size rows, as numpy arrays (array_backend="numpy")
+    or pyarrow arrays (array_backend="arrow"), e.g.:
+
+    ColumnarProjection(
+        type="EpisodeRecorded",
+        fields=["durationInSeconds", "audio.sampleRate"],
+        init=lambda: 0.0,
+        reducer=lambda total, columns: total + columns["durationInSeconds"].sum(),
+        dtypes={"durationInSeconds": "float64"},
+    )
+
+    Nested fields are selected with dots. dtypes are numpy dtypes or pyarrow DataTypes
+    depending on the backend. Missing fields are None, which numpy turns into nan for
+    float dtypes and arrow into nulls.
+    Messages of other types are skipped without building a MessageFromSubscription
+    """
+
+    def __init__(
+        self,
+        type: str,
+        fields: List[str],
+        init: Callable[[], T],
+        reducer: Callable[[T, Dict[str, Any]], T],
+        batch_size: int = 10_000,
+        array_backend: str = "numpy",
+        dtypes: Optional[Dict[str, Any]] = None,
+    ):
+        if array_backend not in _ARRAY_BACKENDS:
+            raise ValueError(
+                f"array_backend must be one of {_ARRAY_BACKENDS}, got {array_backend}"
+            )
+        if len(fields) == 0:
+            raise ValueError("ColumnarProjection requires at least one field")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        super().__init__(init, handlers={})
+        self._type = type
+        self._fields = fields
+        self._field_paths = [field.split(".") for field in fields]
+        self._reducer = reducer
+        self._batch_size = batch_size
+        self._dtypes = dtypes or {}
+        self._create_array = _get_array_factory(array_backend)
+        self._columns: List[List[Any]] = [[] for _ in fields]
+
+    def handle(self, type: str, message: MessageFromSubscription):
+        if type == self._type:
+            self._append_row(message.data)
+
+    def handle_js_message(self, nats_subject_prefix: str, jetstream_message: "Msg"):
+        parsed_message_data: dict = json.loads(jetstream_message.data)
+        if parsed_message_data["type"] == self._type:
+            self._append_row(parsed_message_data["data"])
+
+    def get_result(self) -> T:
+        self._flush()
+        return self._entity
+
+    def _append_row(self, data: Dict[str, Any]):
+        for column, path in zip(self._columns, self._field_paths):
+            value: Any = data
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            column.append(value)
+        if len(self._columns[0]) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._columns[0]) == 0:
+            return
+        arrays = {
+            field: self._create_array(column, self._dtypes.get(field))
+            for field, column in zip(self._fields, self._columns)
+        }
+        self._columns = [[] for _ in self._fields]
+        self._entity = self._reducer(self._entity, arrays)
+
+
+def _get_array_factory(array_backend: str) -> Callable[[List[Any], Any], Any]:
+    if array_backend == "numpy":
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError(
+                'ColumnarProjection with array_backend="numpy" requires numpy, install message-store[numpy]'
+            ) from None
+        return lambda values, dtype: numpy.array(values, dtype=dtype)
+
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(
+            'ColumnarProjection with array_backend="arrow" requires pyarrow, install message-store[arrow]'
+        ) from None
+    return lambda values, dtype: pyarrow.array(values, type=dtype)
@@ -1,11 +1,10 @@
-from nats.js.client import JetStreamContext
+from ..backends.backend import JetStreamBackend
 from nats.js.api import ConsumerInfo
 from .projection import Projection
-from ..message_from_subscription import MessageFromSubscription
 
 
 class Fetch:
-    def __init__(self, jetstream_client: JetStreamContext, nats_subject_prefix: str):
+    def __init__(self, jetstream_client: JetStreamBackend, nats_subject_prefix: str):
         self._jetstream_client = jetstream_client
         self._nats_subject_prefix = nats_subject_prefix
 
@@ -28,10 +27,7 @@ class Fetch:
                 if until_seq is not None and jetstream_message.metadata.sequence.stream > until_seq:
                     break
 
-                message = MessageFromSubscription.create_from_js_message(
-                    self._nats_subject_prefix, jetstream_message
-                )
-                projection.handle(message.type, message)
+                projection.handle_js_message(self._nats_subject_prefix, jetstream_message)
                 processed_count += 1
                 if processed_count == total_messages_in_stream:                                
                     break
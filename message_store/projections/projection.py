@@ -1,6 +1,9 @@
-from typing import Generic, TypeVar, Callable
+from typing import TYPE_CHECKING, Generic, TypeVar, Callable
 from ..message_from_subscription import MessageFromSubscription
 
+if TYPE_CHECKING:
+    from nats.aio.msg import Msg
+
 T = TypeVar("T")
 
 
@@ -17,5 +20,11 @@ class Projection(Generic[T]):
         if type in self.handlers:
             self._entity = self.handlers[type](self._entity, message)
 
+    def handle_js_message(self, nats_subject_prefix: str, jetstream_message: "Msg"):
+        message = MessageFromSubscription.create_from_js_message(
+            nats_subject_prefix, jetstream_message
+        )
+        self.handle(message.type, message)
+
     def get_result(self) -> T:
         return self._entity
@@ -1,8 +1,11 @@
-from typing import Callable, Any, Coroutine, TypeVar, cast
+from typing import Callable, Any, Coroutine, Optional, TypeVar, cast
 import asyncio
 import traceback
 import inspect
 import itertools
+import random
+import time
+from .circuit_breaker import CircuitBreaker
 from .message_store_logger import message_store_logger
 
 T = TypeVar("T")
@@ -12,30 +15,103 @@ async def retry_with_exponential_backoff(
     is_retriable: Callable[[Exception], bool],
     max_retries: int = 3,
     initial_backoff_time_in_seconds: float = 0.25,
+    max_backoff_time_in_seconds: Optional[float] = None,
+    jitter: bool = True,
+    deadline_in_seconds: Optional[float] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
 ) -> T:
     """
     Retries the given function with exponential backoff
+    With jitter the actual wait is random between 0 and the backoff time ("full jitter")
+    so that clients failing at the same time don't retry in lockstep.
+    deadline_in_seconds is a budget for retrying, not a timeout: an attempt in progress
+    is never cancelled, but a retry whose backoff would end after the deadline is not
+    attempted and the last error is raised instead.
+    When a circuit_breaker is given, CircuitOpenException is raised (without calling fn)
+    while it's open. The whole call, retries included, counts as a single success or
+    failure: a failure is recorded only once retriable errors have exhausted the retries.
+    If the circuit opens while retrying, the last error is raised instead of retrying
     """
+    is_probe = circuit_breaker.before_call() if circuit_breaker is not None else False
+    try:
+        return_value = await _retry_with_exponential_backoff(
+            fn,
+            is_retriable,
+            max_retries,
+            initial_backoff_time_in_seconds,
+            max_backoff_time_in_seconds,
+            jitter,
+            deadline_in_seconds,
+            circuit_breaker if not is_probe else None,
+        )
+    except Exception as e:
+        if circuit_breaker is not None:
+            if is_retriable(e):
+                circuit_breaker.record_failure(is_probe)
+            else:
+                # the call reached the cluster, so as far as availability goes it succeeded
+                circuit_breaker.record_success(is_probe)
+        raise
+    except BaseException:
+        if circuit_breaker is not None:
+            circuit_breaker.record_abandoned(is_probe)
+        raise
+    if circuit_breaker is not None:
+        circuit_breaker.record_success(is_probe)
+    return return_value
+
+
+async def _retry_with_exponential_backoff(
+    fn: Callable[[], T | Coroutine[Any, Any, T]],
+    is_retriable: Callable[[Exception], bool],
+    max_retries: int,
+    initial_backoff_time_in_seconds: float,
+    max_backoff_time_in_seconds: Optional[float],
+    jitter: bool,
+    deadline_in_seconds: Optional[float],
+    circuit_breaker: Optional[CircuitBreaker],
+) -> T:
+    started_at = time.monotonic()
     current_backoff_time_in_seconds = initial_backoff_time_in_seconds
     for i in itertools.count():
         try:
             return_value = fn()
             if asyncio.iscoroutine(return_value):
-                return await return_value
-            else:
-                return_value = cast(T, return_value)
-                return return_value
+                return_value = await return_value
+            return cast(T, return_value)
         except Exception as e:
             if not is_retriable(e):
                 raise
             if i >= max_retries - 1:
                 raise
+            backoff_time_in_seconds = (
+                random.uniform(0, current_backoff_time_in_seconds)
+                if jitter
+                else current_backoff_time_in_seconds
+            )
+            if (
+                deadline_in_seconds is not None
+                and time.monotonic() - started_at + backoff_time_in_seconds > deadline_in_seconds
+            ):
+                message_store_logger.warning(
+                    f"Not retrying, waiting {backoff_time_in_seconds:.2f} seconds would exceed the deadline of {deadline_in_seconds} seconds (retry #{i + 1}/{max_retries})"
+                )
+                raise
             fn_source = inspect.getsource(fn)
             message_store_logger.warning(
-                f"{fn_source} failed. Retrying after {current_backoff_time_in_seconds} seconds (retry #{i + 1}/{max_retries})\n",
-                traceback.format_exc(),
+                f"{fn_source} failed. Retrying after {backoff_time_in_seconds:.2f} seconds (retry #{i + 1}/{max_retries})\n"
+                f"{traceback.format_exc()}"
             )
-            await asyncio.sleep(current_backoff_time_in_seconds)
+            await asyncio.sleep(backoff_time_in_seconds)
             current_backoff_time_in_seconds *= 2
+            if max_backoff_time_in_seconds is not None:
+                current_backoff_time_in_seconds = min(
+                    current_backoff_time_in_seconds, max_backoff_time_in_seconds
+                )
+            if circuit_breaker is not None and circuit_breaker.state != CircuitBreaker.CLOSED:
+                message_store_logger.warning(
+                    f"Not retrying, the circuit opened while waiting (retry #{i + 1}/{max_retries})"
+                )
+                raise
 
-    raise RuntimeError("retry_with_exponential_backoff: exited loop without returning or raising an exception")
\ No newline at end of file
+    raise RuntimeError("retry_with_exponential_backoff: exited loop without returning or raising an exception")
@@ -0,0 +1,109 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from ..message_from_subscription import MessageFromSubscription
+from ..message_store_logger import message_store_logger
+
+T = TypeVar("T")
+
+
+class CancelledAfterHandlerFinished(asyncio.CancelledError):
+    """
+    Raised instead of a plain CancelledError when the task waiting for a handler in
+    an executor was cancelled but the handler, which can't be interrupted, still ran to
+    completion. The caller can settle the message as usual before letting it propagate.
+    result is what the handler returned in the executor
+    """
+
+    def __init__(self, result: Any = None):
+        super().__init__()
+        self.result = result
+
+
+class ExecutorHandler:
+    """
+    Wraps a synchronous handler so the subscription runs it in an executor instead
+    of on the event loop, e.g. handlers={"AudioUploaded": ExecutorHandler(parse_audio, process_pool)}
+    With executor=None the event loop's default thread pool is used.
+    With a ProcessPoolExecutor the handler must be picklable (a module level function)
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[MessageFromSubscription], None],
+        executor: Optional[Executor] = None,
+    ):
+        if asyncio.iscoroutinefunction(handler):
+            raise TypeError(
+                "ExecutorHandler requires a synchronous handler, coroutine handlers are awaited on the event loop"
+            )
+        self.handler = handler
+        self.executor = executor
+
+    def __call__(self, message: MessageFromSubscription) -> None:
+        self.handler(message)
+
+
+async def run_handler_in_executor(
+    executor: Optional[Executor],
+    handler: Callable[[MessageFromSubscription], None],
+    message: MessageFromSubscription,
+) -> None:
+    """
+    Runs the handler in the executor and waits for it without blocking the event loop.
+    Process workers receive the message in its compact form and report back whether it
+    was marked for termination, so ack/nak/term still happen on the event loop.
+    A thread or process can't be interrupted, so if the waiting task is cancelled (e.g.
+    by a drain timeout) it keeps waiting for the handler to finish instead of letting
+    the message be nak'ed and redelivered while the handler is still running, and
+    then raises CancelledAfterHandlerFinished (or a plain CancelledError if the
+    handler failed)
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(executor, ProcessPoolExecutor):
+        try:
+            is_marked_for_termination = await _wait_for_handler(
+                loop.run_in_executor(
+                    executor, _handle_compact_message, handler, message.to_compact()
+                )
+            )
+        except CancelledAfterHandlerFinished as cancellation:
+            if cancellation.result:
+                message.mark_for_termination()
+            raise
+        if is_marked_for_termination:
+            message.mark_for_termination()
+    else:
+        await _wait_for_handler(loop.run_in_executor(executor, handler, message))
+
+
+async def _wait_for_handler(future: "asyncio.Future[T]") -> T:
+    is_cancelled = False
+    while True:
+        try:
+            result = await asyncio.shield(future)
+            break
+        except asyncio.CancelledError:
+            if future.cancelled():
+                raise
+            if not is_cancelled:
+                message_store_logger.warning(
+                    "Cancelled while a handler is running in an executor, waiting for it to finish"
+                )
+            is_cancelled = True
+        except Exception as e:
+            if is_cancelled:
+                raise asyncio.CancelledError() from e
+            raise
+    if is_cancelled:
+        raise CancelledAfterHandlerFinished(result)
+    return result
+
+
+def _handle_compact_message(
+    handler: Callable[[MessageFromSubscription], None], compact_message: tuple
+) -> bool:
+    message = MessageFromSubscription.create_from_compact(compact_message)
+    handler(message)
+    return message.is_marked_for_termination()
@@ -0,0 +1,104 @@
+import base64
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from nats.js.kv import KeyValue
+import nats.js.errors
+
+from ..backends.backend import JetStreamBackend
+from ..message_store_logger import message_store_logger
+
+
+class IdempotencyStore(ABC):
+    """
+    Keeps track of which messages a subscription has already processed so that
+    redeliveries (e.g. after an AckWait timeout) don't run the handler twice
+    """
+
+    @abstractmethod
+    async def was_processed(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def mark_as_processed(self, key: str) -> None:
+        ...
+
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """
+    Bounded LRU of processed keys, local to this process
+    """
+
+    def __init__(self, max_size: int = 10_000):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._max_size = max_size
+        self._keys: OrderedDict[str, None] = OrderedDict()
+
+    async def was_processed(self, key: str) -> bool:
+        if key not in self._keys:
+            return False
+        self._keys.move_to_end(key)
+        return True
+
+    async def mark_as_processed(self, key: str) -> None:
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self._max_size:
+            self._keys.popitem(last=False)
+
+
+class JetStreamIdempotencyStore(IdempotencyStore):
+    """
+    Stores processed keys in a JetStream key-value bucket (created if missing) whose
+    entries expire after ttl_in_seconds, so duplicates are detected across processes.
+    A local LRU in front of it avoids a round-trip for recently seen keys
+    """
+
+    def __init__(
+        self,
+        jetstream_client: JetStreamBackend,
+        bucket: str,
+        ttl_in_seconds: float = 24 * 60 * 60,
+        local_cache_size: int = 10_000,
+    ):
+        self._jetstream_client = jetstream_client
+        self._bucket = bucket
+        self._ttl_in_seconds = ttl_in_seconds
+        self._local_cache = InMemoryIdempotencyStore(local_cache_size)
+        self._key_value: Optional[KeyValue] = None
+
+    async def was_processed(self, key: str) -> bool:
+        if await self._local_cache.was_processed(key):
+            return True
+        key_value = await self._get_key_value()
+        try:
+            await key_value.get(self._to_bucket_key(key))
+        except (nats.js.errors.KeyNotFoundError, nats.js.errors.KeyDeletedError):
+            return False
+        await self._local_cache.mark_as_processed(key)
+        return True
+
+    async def mark_as_processed(self, key: str) -> None:
+        await self._local_cache.mark_as_processed(key)
+        key_value = await self._get_key_value()
+        await key_value.put(self._to_bucket_key(key), b"")
+
+    async def _get_key_value(self) -> KeyValue:
+        if self._key_value is None:
+            try:
+                self._key_value = await self._jetstream_client.key_value(self._bucket)
+            except nats.js.errors.BucketNotFoundError:
+                message_store_logger.info(
+                    f"Idempotency bucket {self._bucket} does not exist, creating it with a ttl of {self._ttl_in_seconds} seconds"
+                )
+                self._key_value = await self._jetstream_client.create_key_value(
+                    bucket=self._bucket, ttl=self._ttl_in_seconds
+                )
+        return self._key_value
+
+    @staticmethod
+    def _to_bucket_key(key: str) -> str:
+        # Nats-Msg-Id can contain characters that are not valid in a key-value key
+        return base64.urlsafe_b64encode(key.encode("utf8")).decode("ascii")
@@ -1,10 +1,16 @@
 from nats.errors import TimeoutError, ConnectionClosedError
-from nats.aio.client import Client as NatsClient
-from nats.js.client import JetStreamContext
 from nats.aio.msg import Msg
 from typing import Dict, Callable, Optional
+from concurrent.futures import Executor
+from ..backends.backend import Backend, JetStreamBackend, PullSubscriptionBackend
 from ..message_from_subscription import MessageFromSubscription
 from .progress_reporter import ProgressReporter
+from .idempotency_store import IdempotencyStore
+from .executor_handler import (
+    CancelledAfterHandlerFinished,
+    ExecutorHandler,
+    run_handler_in_executor,
+)
 import asyncio
 from ..message_store_logger import message_store_logger
 import json
@@ -13,14 +19,17 @@ import json
 class Subscription:
     def __init__(
         self,
-        nats_connection: NatsClient,
-        jetstream_client: JetStreamContext,
+        nats_connection: Backend,
+        jetstream_client: JetStreamBackend,
         nats_subject_prefix: str,
         subject: str,
         consumer_name: str,
         handlers: Dict[str, Callable[[MessageFromSubscription], None]],
         max_number_of_retries: Optional[int] = 3,
         dead_letter_subject: Optional[str] = None,
+        idempotency_store: Optional[IdempotencyStore] = None,
+        executor: Optional[Executor] = None,
+        release_connection: Optional[Callable[[], None]] = None,
     ):
         self._nats_connection = nats_connection
         self._jetstream_client = jetstream_client
@@ -32,26 +41,30 @@ class Subscription:
         self._pull_wait_timeout_in_secs = 5
         self._max_number_of_retries = max_number_of_retries
         self._dead_letter_subject = dead_letter_subject
+        self._idempotency_store = idempotency_store
+        self._executor = executor
+        self._release_connection = release_connection
         self._running_subscription_task: Optional[asyncio.Task]
         self._running_subscription_task = None
+        self._stop_requested = asyncio.Event()
+
+    @property
+    def subject(self) -> str:
+        return self._subject
+
+    @property
+    def consumer_name(self) -> str:
+        return self._consumer_name
 
     def start(self) -> asyncio.Task:
         self._is_subscription_active = True
+        self._stop_requested.clear()
 
         async def start_pull_subscription():
-            pull_subscription = await self._jetstream_client.pull_subscribe(
-                f"{self._nats_subject_prefix}{self._subject}",
-                durable=self._consumer_name,
-            )
-            progress_reporter = ProgressReporter()
+            pull_subscription = await self.create_pull_subscription()
             while not self._nats_connection.is_closed and self._is_subscription_active:
                 try:
-                    jetstream_messages = await pull_subscription.fetch(
-                        batch=1, timeout=self._pull_wait_timeout_in_secs
-                    )
-                    jetstream_message = jetstream_messages[
-                        0
-                    ]  # if there are no messages then TimeoutError will be raised, if it gets here there's 1 message
+                    jetstream_message = await self._fetch_next_message(pull_subscription)
                 except TimeoutError:
                     message_store_logger.debug(
                         f'No messages arrived during the pull_wait_timeout_in_secs ({self._pull_wait_timeout_in_secs}) for subject {self._nats_subject_prefix}{self._subject}. "Re-arming" wait for messages'
@@ -62,61 +75,210 @@ class Subscription:
                         f"Connection to nats was closed, stopping subscription to {self._subject}"
                     )
                     break
+                if jetstream_message is None:
+                    break
 
-                try:
-                    if self._was_message_redelivered_too_many_times(jetstream_message):
-                        await self._terminate_message(jetstream_message)
-                        continue
+                if not await self.handle_message(jetstream_message):
+                    break
 
-                    progress_reporter.start_reporting_progress(jetstream_message)
+        self._running_subscription_task = asyncio.create_task(start_pull_subscription())
+        return self._running_subscription_task
 
-                    message = MessageFromSubscription.create_from_js_message(
-                        self._nats_subject_prefix,
-                        jetstream_message,
-                        self._max_number_of_retries,
-                    )
-                    if message.type in self._handlers:
-                        message_store_logger.debug(
-                            f"Calling handler for {message.type}, full message: {json.dumps(message.to_dict(), indent=2)}",
-                        )
-                        if asyncio.iscoroutinefunction(self._handlers[message.type]):
-                            await self._handlers[message.type](message)
-                        else:
-                            self._handlers[message.type](message)
-                    else:
-                        message_store_logger.debug(
-                            f"Ignoring message. Could not find a handler for message with type {message.type}, subject: {jetstream_message.subject}, stream: {jetstream_message.metadata.stream}. Full message:"\
-                            f"{json.dumps(message.to_dict(), indent=2)}",
-                        )
-                    if message.is_marked_for_termination():
-                        await self._terminate_message(jetstream_message)
-                    else:
-                        await jetstream_message.ack()
-                except ConnectionClosedError:
+    async def stop(self, drain_timeout_in_secs: Optional[float] = None):
+        """
+        Stops pulling new messages right away and waits for the message being
+        handled (if any) to finish. If drain_timeout_in_secs is provided and the
+        handler doesn't finish within it, the handler is cancelled and the message
+        is nak'ed so it's redelivered immediately instead of waiting for AckWait.
+        Handlers running in an executor can't be interrupted: they get another
+        drain_timeout_in_secs to finish (their message is then acked or nak'ed as
+        usual), after which stop returns and leaves them finishing in the background
+        """
+        self._is_subscription_active = False
+        self._stop_requested.set()
+        try:
+            if self._running_subscription_task:
+                running_subscription_task = self._running_subscription_task
+                _, pending = await asyncio.wait(
+                    {running_subscription_task}, timeout=drain_timeout_in_secs
+                )
+                if pending:
                     message_store_logger.warning(
-                        f"Connection to nats/jetstream was closed while handling {message}. It will be retried if it wasn't the last attempt (is_last_attempt != False). Stopping subscription to {self._subject}"
+                        f"Subscription to {self._subject} did not finish handling its message within {drain_timeout_in_secs} seconds, cancelling it"
                     )
-                    break
-                except (Exception, asyncio.CancelledError) as exception:
-                    message_store_logger.warning(
-                        f"Failed to handle message with subject {jetstream_message.subject}, seq: {jetstream_message.metadata.sequence.stream}, data: {jetstream_message.data}, exception: {type(exception).__name__} {exception}"
+                    running_subscription_task.cancel()
+                    _, pending = await asyncio.wait(
+                        {running_subscription_task}, timeout=drain_timeout_in_secs
                     )
-                    if not self._nats_connection.is_closed:
-                        if message.is_marked_for_termination():
-                            await self._terminate_message(jetstream_message)
-                        else:
-                            await jetstream_message.nak()
-                finally:
-                    progress_reporter.stop_reporting_progress()
+                    if pending:
+                        message_store_logger.warning(
+                            f"Subscription to {self._subject} is still waiting for a handler running in an executor, leaving it to finish in the background"
+                        )
+                self._running_subscription_task = None
+                if not pending:
+                    try:
+                        await running_subscription_task
+                    except asyncio.CancelledError:
+                        pass
+        finally:
+            self.release_connection()
 
-        self._running_subscription_task = asyncio.create_task(start_pull_subscription())
-        return self._running_subscription_task
+    def release_connection(self) -> None:
+        """
+        Gives the pool connection this subscription is pinned to back, once.
+        Internal API, used by stop() and by SubscriptionManager
+        """
+        if self._release_connection is not None:
+            self._release_connection()
+            self._release_connection = None
 
-    async def stop(self):
-        self._is_subscription_active = False
-        if self._running_subscription_task:
-            await self._running_subscription_task
-            self._running_subscription_task = None
+    async def create_pull_subscription(self) -> PullSubscriptionBackend:
+        """
+        Binds a pull subscription to this subscription's durable consumer.
+        Internal API, used by start() and by SubscriptionManager
+        """
+        return await self._jetstream_client.pull_subscribe(
+            f"{self._nats_subject_prefix}{self._subject}",
+            durable=self._consumer_name,
+        )
+
+    async def handle_message(self, jetstream_message: Msg) -> bool:
+        """
+        Calls the handler for the message and acks, naks or terms it accordingly.
+        Returns False if the connection was closed and the subscription should stop.
+        Internal API, used by start() and by SubscriptionManager
+        """
+        progress_reporter = ProgressReporter()
+        message: Optional[MessageFromSubscription] = None
+        cancellation: Optional[asyncio.CancelledError] = None
+        try:
+            idempotency_key = self._get_idempotency_key(jetstream_message)
+            if self._idempotency_store is not None and await self._idempotency_store.was_processed(idempotency_key):
+                message_store_logger.debug(
+                    f"Skipping already processed message #{jetstream_message.metadata.sequence.stream}, subject {jetstream_message.subject} from stream {jetstream_message.metadata.stream}"
+                )
+                await jetstream_message.ack()
+                return True
+
+            if self._was_message_redelivered_too_many_times(jetstream_message):
+                await self._terminate_message(jetstream_message)
+                return True
+
+            progress_reporter.start_reporting_progress(jetstream_message)
+
+            message = MessageFromSubscription.create_from_js_message(
+                self._nats_subject_prefix,
+                jetstream_message,
+                self._max_number_of_retries,
+            )
+            if message.type in self._handlers:
+                message_store_logger.debug(
+                    f"Calling handler for {message.type}, full message: {json.dumps(message.to_dict(), indent=2)}",
+                )
+                try:
+                    await self._call_handler(self._handlers[message.type], message)
+                except CancelledAfterHandlerFinished as e:
+                    # the handler ran to completion, settle its message before stopping
+                    cancellation = e
+            else:
+                message_store_logger.debug(
+                    f"Ignoring message. Could not find a handler for message with type {message.type}, subject: {jetstream_message.subject}, stream: {jetstream_message.metadata.stream}. Full message:"\
+                    f"{json.dumps(message.to_dict(), indent=2)}",
+                )
+            if self._idempotency_store is not None:
+                await self._mark_as_processed(self._idempotency_store, idempotency_key)
+            if message.is_marked_for_termination():
+                await self._terminate_message(jetstream_message)
+            else:
+                await jetstream_message.ack()
+        except ConnectionClosedError:
+            message_store_logger.warning(
+                f"Connection to nats/jetstream was closed while handling {message}. It will be retried if it wasn't the last attempt (is_last_attempt != False). Stopping subscription to {self._subject}"
+            )
+            return False
+        except (Exception, asyncio.CancelledError) as exception:
+            message_store_logger.warning(
+                f"Failed to handle message with subject {jetstream_message.subject}, seq: {jetstream_message.metadata.sequence.stream}, data: {jetstream_message.data!r}, exception: {type(exception).__name__} {exception}"
+            )
+            if not self._nats_connection.is_closed:
+                if message is not None and message.is_marked_for_termination():
+                    await self._terminate_message(jetstream_message)
+                else:
+                    await jetstream_message.nak()
+            if isinstance(exception, asyncio.CancelledError):
+                raise
+        finally:
+            progress_reporter.stop_reporting_progress()
+        if cancellation is not None:
+            raise cancellation
+        return True
+
+    async def _fetch_next_message(self, pull_subscription: PullSubscriptionBackend) -> Optional[Msg]:
+        """
+        Waits for the next message unless stop is requested first, in which case
+        the pull is abandoned and None is returned. A message that arrives together
+        with the stop request is nak'ed since its handler will never be started
+        """
+        fetch_task = asyncio.ensure_future(
+            pull_subscription.fetch(batch=1, timeout=self._pull_wait_timeout_in_secs)
+        )
+        stop_requested_task = asyncio.ensure_future(self._stop_requested.wait())
+        try:
+            await asyncio.wait(
+                {fetch_task, stop_requested_task},
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            stop_requested_task.cancel()
+            if not fetch_task.done():
+                fetch_task.cancel()
+                await asyncio.wait({fetch_task})
+        if fetch_task.cancelled():
+            await abandon_pull_subscription(pull_subscription)
+            return None
+        jetstream_messages = fetch_task.result()
+        # if there are no messages then TimeoutError will be raised, if it gets here there's 1 message
+        if self._stop_requested.is_set():
+            await jetstream_messages[0].nak()
+            return None
+        return jetstream_messages[0]
+
+    async def _call_handler(self, handler: Callable, message: MessageFromSubscription) -> None:
+        """
+        Coroutine handlers are awaited on the event loop. Synchronous handlers run in
+        their ExecutorHandler's executor, in the subscription's executor if it has one,
+        or directly on the event loop otherwise
+        """
+        if isinstance(handler, ExecutorHandler):
+            await run_handler_in_executor(handler.executor, handler.handler, message)
+        elif asyncio.iscoroutinefunction(handler):
+            await handler(message)
+        elif self._executor is not None:
+            await run_handler_in_executor(self._executor, handler, message)
+        else:
+            handler(message)
+
+    def _get_idempotency_key(self, message: Msg) -> str:
+        """
+        Messages are identified by their Nats-Msg-Id header when published with one,
+        otherwise by their stream sequence. The consumer name is part of the key so
+        that consumers sharing an idempotency store don't skip each other's messages
+        """
+        msg_id = message.headers.get("Nats-Msg-Id") if message.headers else None
+        if msg_id is not None:
+            return f"{self._consumer_name}.{message.metadata.stream}.msg-id.{msg_id}"
+        return f"{self._consumer_name}.{message.metadata.stream}.seq.{message.metadata.sequence.stream}"
+
+    async def _mark_as_processed(
+        self, idempotency_store: IdempotencyStore, idempotency_key: str
+    ) -> None:
+        # the handler already ran, failing to record that shouldn't cause it to run again
+        try:
+            await idempotency_store.mark_as_processed(idempotency_key)
+        except Exception as e:
+            message_store_logger.warning(
+                f"Failed to record {idempotency_key} as processed in the idempotency store: {e}"
+            )
 
     def _was_message_redelivered_too_many_times(self, message: Msg):
         if self._max_number_of_retries is None:
@@ -143,3 +305,31 @@ class Subscription:
                 dead_letter_subject_for_failed_msg,
                 message.data,
             )
+
+
+async def abandon_pull_subscription(pull_subscription: PullSubscriptionBackend) -> None:
+    """
+    A cancelled fetch leaves its pull request on the server until it expires, and a
+    message delivered for it in the meantime would wait in the pending queue until
+    AckWait. Unsubscribing stops more from arriving and those already received are
+    nak'ed so they're redelivered immediately
+    """
+    try:
+        await pull_subscription.unsubscribe()
+    except Exception as e:
+        message_store_logger.debug(
+            f"Failed to unsubscribe abandoned pull subscription: {type(e).__name__} {e}"
+        )
+    while pull_subscription.pending_msgs > 0:
+        try:
+            # with messages pending fetch returns the next one without a new pull request
+            jetstream_messages = await pull_subscription.fetch(batch=1, timeout=0.1)
+        except Exception:
+            break
+        for jetstream_message in jetstream_messages:
+            try:
+                await jetstream_message.nak()
+            except Exception as e:
+                message_store_logger.warning(
+                    f"Failed to nak message #{jetstream_message.metadata.sequence.stream} received after stopping: {type(e).__name__} {e}"
+                )
@@ -0,0 +1,336 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from nats.errors import TimeoutError, ConnectionClosedError
+
+from .subscription import Subscription, abandon_pull_subscription
+from ..backends.backend import PullSubscriptionBackend
+from ..message_store_logger import message_store_logger
+
+
+class SubscriptionHealth:
+    def __init__(
+        self,
+        subject: str,
+        consumer_name: str,
+        weight: int,
+        num_pending: Optional[int],
+        num_ack_pending: Optional[int],
+        is_idle: bool,
+        is_closed: bool,
+        messages_handled: int,
+        last_error: Optional[str],
+    ):
+        self.subject = subject
+        self.consumer_name = consumer_name
+        self.weight = weight
+        self.num_pending = num_pending
+        self.num_ack_pending = num_ack_pending
+        self.is_idle = is_idle
+        self.is_closed = is_closed
+        self.messages_handled = messages_handled
+        self.last_error = last_error
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "subject": self.subject,
+            "consumer_name": self.consumer_name,
+            "weight": self.weight,
+            "num_pending": self.num_pending,
+            "num_ack_pending": self.num_ack_pending,
+            "is_idle": self.is_idle,
+            "is_closed": self.is_closed,
+            "messages_handled": self.messages_handled,
+            "last_error": self.last_error,
+        }
+
+    def __repr__(self):
+        return str(self.to_dict())
+
+
+class _ManagedSubscription:
+    def __init__(self, subscription: Subscription, weight: int):
+        self.subscription = subscription
+        self.weight = weight
+        self.current_weight = 0
+        self.pull_subscription: Optional[PullSubscriptionBackend] = None
+        self.task: Optional[asyncio.Task] = None
+        self.is_handling = False
+        self.is_closed = False
+        self.idle_interval_in_secs = 0.0
+        self.next_poll_at = 0.0
+        self.messages_handled = 0
+        self.last_error: Optional[str] = None
+
+
+class SubscriptionManager:
+    """
+    Runs many durable subscriptions from a single scheduler instead of one long-poll
+    loop per subscription.
+    Subscriptions with messages are polled again right away, while idle ones are polled
+    with a short timeout and then backed off exponentially up to
+    max_idle_poll_interval_in_secs, so they cost almost nothing.
+    Whenever there's capacity the next subscription to poll is picked by smooth weighted
+    round-robin among the ready ones, so a hot subscription can't starve the others.
+    At most max_concurrency subscriptions are polled or handling a message at a time
+    (each subscription still handles its messages one at a time, in order), and the
+    messages being pulled or handled are kept within max_in_flight_bytes: each poll
+    reserves max_message_size_in_bytes of the budget up front (the stream's max_msg_size
+    is a safe value), which is swapped for the actual size once its message arrives.
+    The subscriptions added must not be started on their own
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 10,
+        max_in_flight_bytes: int = 2**26,  # 64MB
+        poll_timeout_in_secs: float = 0.5,
+        max_idle_poll_interval_in_secs: float = 5,
+        max_message_size_in_bytes: int = 2**22,  # 4MB, the max_msg_size ensure_stream creates streams with
+    ):
+        self._max_concurrency = max_concurrency
+        self._max_in_flight_bytes = max_in_flight_bytes
+        self._max_message_size_in_bytes = max_message_size_in_bytes
+        self._poll_timeout_in_secs = poll_timeout_in_secs
+        self._max_idle_poll_interval_in_secs = max_idle_poll_interval_in_secs
+        self._managed_subscriptions: List[_ManagedSubscription] = []
+        self._tasks: Set[asyncio.Task] = set()
+        self._in_flight_bytes = 0
+        self._is_active = False
+        self._wakeup = asyncio.Event()
+        self._running_scheduler_task: Optional[asyncio.Task] = None
+
+    def add_subscription(self, subscription: Subscription, weight: int = 1) -> None:
+        if weight < 1:
+            raise ValueError("weight must be at least 1")
+        self._managed_subscriptions.append(_ManagedSubscription(subscription, weight))
+        self._wakeup.set()
+
+    @property
+    def subscriptions(self) -> List[Subscription]:
+        return [
+            managed_subscription.subscription
+            for managed_subscription in self._managed_subscriptions
+        ]
+
+    def start(self) -> asyncio.Task:
+        self._is_active = True
+        self._running_scheduler_task = asyncio.create_task(self._run_scheduler())
+        return self._running_scheduler_task
+
+    async def stop(self, drain_timeout_in_secs: Optional[float] = None) -> None:
+        """
+        Stops polling right away and waits for the messages being handled to finish,
+        then unsubscribes every pull subscription and releases the pool connections
+        of the subscriptions, which don't need to be stopped on their own.
+        Handlers still running after drain_timeout_in_secs are cancelled and their
+        messages nak'ed so they're redelivered immediately. Handlers running in an
+        executor can't be interrupted: they get another drain_timeout_in_secs to finish,
+        after which stop returns and leaves them finishing in the background
+        """
+        self._is_active = False
+        self._wakeup.set()
+        if self._running_scheduler_task is not None:
+            await self._running_scheduler_task
+            self._running_scheduler_task = None
+        for managed_subscription in self._managed_subscriptions:
+            if managed_subscription.task is not None and not managed_subscription.is_handling:
+                managed_subscription.task.cancel()
+        if len(self._tasks) > 0:
+            await self._wait_for_tasks(drain_timeout_in_secs)
+        for managed_subscription in self._managed_subscriptions:
+            pull_subscription = managed_subscription.pull_subscription
+            managed_subscription.pull_subscription = None
+            if pull_subscription is not None:
+                await abandon_pull_subscription(pull_subscription)
+            managed_subscription.subscription.release_connection()
+
+    async def _wait_for_tasks(self, drain_timeout_in_secs: Optional[float]) -> None:
+        _, pending = await asyncio.wait(set(self._tasks), timeout=drain_timeout_in_secs)
+        if pending:
+            message_store_logger.warning(
+                f"{len(pending)} handlers did not finish within {drain_timeout_in_secs} seconds, cancelling them"
+            )
+            for task in pending:
+                task.cancel()
+            _, pending = await asyncio.wait(pending, timeout=drain_timeout_in_secs)
+            if pending:
+                still_running = [
+                    managed_subscription.subscription.consumer_name
+                    for managed_subscription in self._managed_subscriptions
+                    if managed_subscription.task in pending
+                ]
+                message_store_logger.warning(
+                    f"Handlers running in an executor for {still_running} did not finish, leaving them to finish in the background"
+                )
+
+    async def get_health(self) -> List[SubscriptionHealth]:
+        """
+        Reports each subscription's state, including its lag (num_pending) as seen by
+        the jetstream consumer. Consumers that haven't been polled yet report None
+        """
+        return list(
+            await asyncio.gather(
+                *[
+                    self._get_subscription_health(managed_subscription)
+                    for managed_subscription in self._managed_subscriptions
+                ]
+            )
+        )
+
+    async def _get_subscription_health(
+        self, managed_subscription: _ManagedSubscription
+    ) -> SubscriptionHealth:
+        num_pending = None
+        num_ack_pending = None
+        last_error = managed_subscription.last_error
+        if managed_subscription.pull_subscription is not None:
+            try:
+                consumer_info = await managed_subscription.pull_subscription.consumer_info()
+                num_pending = consumer_info.num_pending
+                num_ack_pending = consumer_info.num_ack_pending
+            except Exception as e:
+                last_error = f"{type(e).__name__} {e}"
+        return SubscriptionHealth(
+            subject=managed_subscription.subscription.subject,
+            consumer_name=managed_subscription.subscription.consumer_name,
+            weight=managed_subscription.weight,
+            num_pending=num_pending,
+            num_ack_pending=num_ack_pending,
+            is_idle=managed_subscription.idle_interval_in_secs > 0,
+            is_closed=managed_subscription.is_closed,
+            messages_handled=managed_subscription.messages_handled,
+            last_error=last_error,
+        )
+
+    async def _run_scheduler(self) -> None:
+        while self._is_active:
+            self._wakeup.clear()
+            managed_subscription = self._pick_next_subscription()
+            if managed_subscription is None:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(),
+                        timeout=self._get_time_until_next_poll()
+                        if self._has_capacity()
+                        else None,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # reserved before the fetch so concurrent polls can't overrun the budget
+            self._in_flight_bytes += self._max_message_size_in_bytes
+            task = asyncio.create_task(
+                self._poll_and_handle(
+                    managed_subscription, self._max_message_size_in_bytes
+                )
+            )
+            managed_subscription.task = task
+            self._tasks.add(task)
+            task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._wakeup.set()
+
+    def _pick_next_subscription(self) -> Optional[_ManagedSubscription]:
+        if not self._has_capacity():
+            return None
+        now = time.monotonic()
+        ready = [
+            managed_subscription
+            for managed_subscription in self._managed_subscriptions
+            if managed_subscription.task is None
+            and not managed_subscription.is_closed
+            and managed_subscription.next_poll_at <= now
+        ]
+        if len(ready) == 0:
+            return None
+        total_weight = 0
+        for managed_subscription in ready:
+            managed_subscription.current_weight += managed_subscription.weight
+            total_weight += managed_subscription.weight
+        picked = max(ready, key=lambda m: m.current_weight)
+        picked.current_weight -= total_weight
+        return picked
+
+    def _has_capacity(self) -> bool:
+        # with nothing in flight a poll is always allowed, even if a message could exceed the budget on its own
+        return len(self._tasks) < self._max_concurrency and (
+            self._in_flight_bytes == 0
+            or self._in_flight_bytes + self._max_message_size_in_bytes
+            <= self._max_in_flight_bytes
+        )
+
+    def _get_time_until_next_poll(self) -> Optional[float]:
+        next_poll_ats = [
+            managed_subscription.next_poll_at
+            for managed_subscription in self._managed_subscriptions
+            if managed_subscription.task is None and not managed_subscription.is_closed
+        ]
+        if len(next_poll_ats) == 0:
+            return None
+        return max(0, min(next_poll_ats) - time.monotonic())
+
+    async def _poll_and_handle(
+        self, managed_subscription: _ManagedSubscription, reserved_bytes: int
+    ) -> None:
+        subscription = managed_subscription.subscription
+        try:
+            if managed_subscription.pull_subscription is None:
+                managed_subscription.pull_subscription = (
+                    await subscription.create_pull_subscription()
+                )
+            pull_subscription = managed_subscription.pull_subscription
+            try:
+                jetstream_messages = await pull_subscription.fetch(
+                    batch=1, timeout=self._poll_timeout_in_secs
+                )
+            except TimeoutError:
+                self._back_off(managed_subscription)
+                return
+            except asyncio.CancelledError:
+                managed_subscription.pull_subscription = None
+                await abandon_pull_subscription(pull_subscription)
+                raise
+            jetstream_message = jetstream_messages[0]
+            message_size = len(jetstream_message.data)
+            self._in_flight_bytes += message_size - reserved_bytes
+            reserved_bytes = message_size
+            if not self._is_active:
+                await jetstream_message.nak()
+                return
+            managed_subscription.is_handling = True
+            managed_subscription.idle_interval_in_secs = 0
+            managed_subscription.next_poll_at = 0
+            if not await subscription.handle_message(jetstream_message):
+                managed_subscription.is_closed = True
+            managed_subscription.messages_handled += 1
+        except ConnectionClosedError:
+            message_store_logger.info(
+                f"Connection to nats was closed, stopping subscription to {subscription.subject}"
+            )
+            managed_subscription.is_closed = True
+        except Exception as e:
+            message_store_logger.warning(
+                f"Failed to poll subscription to {subscription.subject} (consumer {subscription.consumer_name}): {type(e).__name__} {e}"
+            )
+            managed_subscription.last_error = f"{type(e).__name__} {e}"
+            self._back_off(managed_subscription)
+        finally:
+            self._in_flight_bytes -= reserved_bytes
+            managed_subscription.is_handling = False
+            managed_subscription.task = None
+
+    def _back_off(self, managed_subscription: _ManagedSubscription) -> None:
+        managed_subscription.idle_interval_in_secs = min(
+            max(
+                managed_subscription.idle_interval_in_secs * 2,
+                self._poll_timeout_in_secs,
+            ),
+            self._max_idle_poll_interval_in_secs,
+        )
+        managed_subscription.next_poll_at = (
+            time.monotonic() + managed_subscription.idle_interval_in_secs
+        )
@@ -0,0 +1,75 @@
+import unittest
+import unittest.mock as mock
+
+from message_store.circuit_breaker import CircuitBreaker
+from message_store.circuit_open_exception import CircuitOpenException
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("message_store.circuit_breaker.time.monotonic")
+        self.clock = patcher.start()
+        self.clock.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+
+    def test_opens_after_consecutive_failures(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=3)
+
+        for _ in range(3):
+            circuit_breaker.record_failure(circuit_breaker.before_call())
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenException):
+            circuit_breaker.before_call()
+
+    def test_success_resets_consecutive_failures(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2)
+
+        circuit_breaker.record_failure(circuit_breaker.before_call())
+        circuit_breaker.record_success(circuit_breaker.before_call())
+        circuit_breaker.record_failure(circuit_breaker.before_call())
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_limits_concurrent_probes(self):
+        circuit_breaker = create_open_circuit_breaker(max_concurrent_probes=1)
+        self.clock.return_value += 11
+
+        self.assertTrue(circuit_breaker.before_call())
+        with self.assertRaises(CircuitOpenException):
+            circuit_breaker.before_call()
+
+    def test_successful_probe_closes_circuit(self):
+        circuit_breaker = create_open_circuit_breaker()
+        self.clock.return_value += 11
+
+        circuit_breaker.record_success(circuit_breaker.before_call())
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_reopens_circuit(self):
+        circuit_breaker = create_open_circuit_breaker()
+        self.clock.return_value += 11
+
+        circuit_breaker.record_failure(circuit_breaker.before_call())
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_abandoned_probe_frees_its_slot(self):
+        circuit_breaker = create_open_circuit_breaker()
+        self.clock.return_value += 11
+
+        circuit_breaker.record_abandoned(circuit_breaker.before_call())
+
+        self.assertTrue(circuit_breaker.before_call())
+
+
+
+def create_open_circuit_breaker(max_concurrent_probes=1):
+    circuit_breaker = CircuitBreaker(
+        failure_threshold=1,
+        recovery_timeout_in_seconds=10,
+        max_concurrent_probes=max_concurrent_probes,
+    )
+    circuit_breaker.record_failure(circuit_breaker.before_call())
+    return circuit_breaker
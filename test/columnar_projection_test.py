@@ -0,0 +1,108 @@
+import unittest
+import unittest.mock as mock
+import asyncio
+import json
+
+from message_store.projections.columnar_projection import ColumnarProjection
+import fetch_test
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class ColumnarProjectionTests(unittest.TestCase):
+    def test_fetch_reduces_selected_fields_of_matching_type(self):
+        projection = ColumnarProjection(
+            type="TheEvent",
+            fields=["duration"],
+            init=lambda: 0.0,
+            reducer=lambda total, columns: total + columns["duration"].sum(),
+            dtypes={"duration": "float64"},
+        )
+        fetch = fetch_test.TestableFetch(
+            messages_to_return=[
+                {"type": "TheEvent", "data": {"duration": 1.5}},
+                {"type": "UnrelatedEvent", "data": {"duration": 100}},
+                {"type": "TheEvent", "data": {"duration": 2.5}},
+            ]
+        )
+
+        result = asyncio.run(fetch.fetch("subject", projection))
+
+        self.assertEqual(result, 4.0)
+
+    def test_reducer_is_called_once_per_batch(self):
+        reducer = mock.Mock(side_effect=lambda count, columns: count + len(columns["a.b"]))
+        projection = ColumnarProjection(
+            type="TheEvent",
+            fields=["a.b"],
+            init=lambda: 0,
+            reducer=reducer,
+            batch_size=2,
+        )
+
+        for value in range(5):
+            projection.handle_js_message("", create_js_message({"a": {"b": value}}))
+
+        self.assertEqual(projection.get_result(), 5)
+        self.assertEqual(reducer.call_count, 3)
+
+    def test_missing_fields_become_nan_for_float_columns(self):
+        projection = ColumnarProjection(
+            type="TheEvent",
+            fields=["value"],
+            init=lambda: None,
+            reducer=lambda _, columns: columns["value"],
+            dtypes={"value": "float64"},
+        )
+
+        projection.handle_js_message("", create_js_message({"value": 1}))
+        projection.handle_js_message("", create_js_message({}))
+
+        result = projection.get_result()
+        self.assertEqual(result[0], 1.0)
+        self.assertTrue(numpy.isnan(result[1]))
+
+    def test_no_messages_returns_init(self):
+        projection = ColumnarProjection(
+            type="TheEvent",
+            fields=["value"],
+            init=lambda: "init",
+            reducer=lambda _, __: "reduced",
+        )
+
+        self.assertEqual(projection.get_result(), "init")
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class ArrowColumnarProjectionTests(unittest.TestCase):
+    def test_reducer_receives_arrow_arrays_with_nulls_for_missing_fields(self):
+        projection = ColumnarProjection(
+            type="TheEvent",
+            fields=["value"],
+            init=lambda: None,
+            reducer=lambda _, columns: columns["value"],
+            array_backend="arrow",
+            dtypes={"value": pyarrow.float64()},
+        )
+
+        projection.handle_js_message("", create_js_message({"value": 1}))
+        projection.handle_js_message("", create_js_message({}))
+        projection.handle_js_message("", create_js_message({"value": 2}, type="UnrelatedEvent"))
+
+        result = projection.get_result()
+        self.assertIsInstance(result, pyarrow.Array)
+        self.assertEqual(result.type, pyarrow.float64())
+        self.assertEqual(result.to_pylist(), [1.0, None])
+
+
+def create_js_message(data, type="TheEvent"):
+    return mock.Mock(data=json.dumps({"type": type, "data": data}).encode())
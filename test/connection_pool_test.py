@@ -0,0 +1,100 @@
+import unittest
+import unittest.mock as mock
+import asyncio
+from message_store.connection_pool import ConnectionPool
+from message_store import MessageStore
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def test_empty_pool_raises(self):
+        with self.assertRaises(ValueError):
+            ConnectionPool([])
+
+    def test_next_jetstream_round_robins_over_connections(self):
+        pool = ConnectionPool([create_connection_mock() for _ in range(3)])
+
+        jetstreams = [pool.next_jetstream() for _ in range(6)]
+
+        self.assertEqual(jetstreams[:3], jetstreams[3:])
+        self.assertEqual(len(set(map(id, jetstreams[:3]))), 3)
+
+    def test_next_connection_skips_closed_connections(self):
+        connections = [create_connection_mock() for _ in range(3)]
+        connections[1].is_closed = True
+        pool = ConnectionPool(connections)
+
+        used = [pool.next_connection() for _ in range(4)]
+
+        self.assertNotIn(connections[1], used)
+
+    def test_subscriptions_are_pinned_to_least_used_non_primary_connections(self):
+        connections = [create_connection_mock() for _ in range(3)]
+        pool = ConnectionPool(connections)
+
+        pinned = [pool.acquire_connection_for_subscription()[0] for _ in range(4)]
+
+        self.assertEqual(
+            pinned, [connections[1], connections[2], connections[1], connections[2]]
+        )
+
+    def test_next_jetstream_skips_connections_with_pinned_subscriptions(self):
+        connections = [create_connection_mock() for _ in range(3)]
+        pool = ConnectionPool(connections)
+        _, pinned_jetstream = pool.acquire_connection_for_subscription()
+
+        jetstreams = [pool.next_jetstream() for _ in range(6)]
+
+        self.assertNotIn(pinned_jetstream, jetstreams)
+        self.assertEqual(
+            set(map(id, jetstreams)),
+            {id(connections[0].jetstream.return_value), id(connections[2].jetstream.return_value)},
+        )
+
+    def test_connections_are_shared_when_all_have_subscriptions(self):
+        connections = [create_connection_mock() for _ in range(2)]
+        connections[0].is_closed = True
+        pool = ConnectionPool(connections)
+        pool.acquire_connection_for_subscription()
+
+        self.assertIs(pool.next_connection(), connections[1])
+
+    def test_single_connection_pool_pins_subscriptions_to_it(self):
+        connection = create_connection_mock()
+        pool = ConnectionPool([connection])
+
+        self.assertIs(pool.acquire_connection_for_subscription()[0], connection)
+
+    def test_released_connections_are_reused_for_new_subscriptions(self):
+        connections = [create_connection_mock() for _ in range(3)]
+        pool = ConnectionPool(connections)
+        pool.acquire_connection_for_subscription()
+        pool.acquire_connection_for_subscription()
+
+        pool.release_connection_for_subscription(connections[1])
+
+        self.assertIs(pool.acquire_connection_for_subscription()[0], connections[1])
+
+    def test_stopping_a_subscription_releases_its_connection(self):
+        connections = [create_connection_mock() for _ in range(3)]
+        pool = ConnectionPool(connections)
+        message_store = MessageStore(pool, prefix="test")
+        subscription = message_store.create_subscription("subject.>", "consumer", {})
+        message_store.create_subscription("subject.>", "other-consumer", {})
+
+        asyncio.run(subscription.stop())
+
+        self.assertIs(pool.acquire_connection_for_subscription()[0], connections[1])
+
+    def test_message_store_wraps_single_connection_in_pool(self):
+        connection = create_connection_mock()
+
+        message_store = MessageStore(connection, prefix="test")
+
+        self.assertIs(message_store._nats_connection, connection)
+        self.assertIs(message_store._jetstream, connection.jetstream.return_value)
+
+
+def create_connection_mock():
+    connection = mock.Mock(is_closed=False)
+    connection.jetstream.return_value = mock.Mock()
+    return connection
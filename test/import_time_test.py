@@ -0,0 +1,64 @@
+import subprocess
+import sys
+import unittest
+
+
+class ImportTimeTests(unittest.TestCase):
+    def test_importing_message_does_not_import_nats(self):
+        output = run_python(
+            "import sys; from message_store import Message; print('nats' in sys.modules)"
+        )
+
+        self.assertEqual(output.stdout.strip(), "False")
+
+    def test_importing_message_module_directly_does_not_import_nats(self):
+        output = run_python(
+            "import sys; from message_store.message import Message; print('nats' in sys.modules)"
+        )
+
+        self.assertEqual(output.stdout.strip(), "False")
+
+    def test_lazy_exports_resolve_to_the_same_objects(self):
+        output = run_python(
+            "import message_store; from message_store.message_store import MessageStore;"
+            "print(message_store.MessageStore is MessageStore)"
+        )
+
+        self.assertEqual(output.stdout.strip(), "True")
+
+    def test_message_import_is_much_cheaper_than_full_import(self):
+        message_import_time = min(
+            measure_import_time_in_us("from message_store import Message")
+            for _ in range(3)
+        )
+        full_import_time = min(
+            measure_import_time_in_us("from message_store import MessageStore")
+            for _ in range(3)
+        )
+
+        self.assertLess(message_import_time, full_import_time / 2)
+
+
+def run_python(code: str, *flags: str):
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def measure_import_time_in_us(code: str) -> int:
+    """
+    Sums the cumulative -X importtime of the top level imports of a fresh interpreter
+    running code (interpreter startup imports are included, they're the same for every run)
+    """
+    output = run_python(code, "-X", "importtime")
+    total = 0
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            total += int(cumulative)
+    return total
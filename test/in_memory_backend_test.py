@@ -0,0 +1,280 @@
+import unittest
+import asyncio
+import unittest.mock as mock
+
+import nats.errors
+import nats.js.errors
+
+from message_store import (
+    MessageStore,
+    Message,
+    Projection,
+    InMemoryBackend,
+    InMemoryServer,
+    ConnectionPool,
+    JetStreamIdempotencyStore,
+)
+from message_store.backends.in_memory_backend import subject_matches
+
+
+class InMemoryBackendTests(unittest.TestCase):
+    def test_ensure_stream_without_creation_raises(self):
+        message_store = MessageStore(InMemoryBackend(), prefix="test")
+
+        with self.assertRaises(Exception):
+            asyncio.run(message_store.ensure_stream("category"))
+
+    def test_fetch_projects_published_messages(self):
+        async def run():
+            message_store = await create_message_store()
+            for _ in range(3):
+                await message_store.publish_message("category.1", Message("TheEvent", {}))
+            await message_store.publish_message("category.2", Message("TheEvent", {}))
+            return await message_store.fetch(
+                "category.1",
+                Projection(
+                    init=lambda: {"count": 0},
+                    handlers={"TheEvent": lambda state, _: {"count": state["count"] + 1}},
+                ),
+            )
+
+        self.assertEqual(asyncio.run(run()), {"count": 3})
+
+    def test_publish_with_same_msg_id_is_a_duplicate(self):
+        async def run():
+            message_store = await create_message_store()
+            first = await message_store.publish_message(
+                "category.1", Message("TheEvent", {}), msg_id="a"
+            )
+            second = await message_store.publish_message(
+                "category.1", Message("TheEvent", {}), msg_id="a"
+            )
+            return first, second
+
+        first, second = asyncio.run(run())
+
+        self.assertFalse(first.duplicate)
+        self.assertTrue(second.duplicate)
+        self.assertEqual(first.seq, second.seq)
+
+    def test_publishes_to_a_missing_stream_do_not_open_the_circuit(self):
+        async def run():
+            message_store = await create_message_store()
+            for _ in range(2):
+                with self.assertRaises(nats.js.errors.NoStreamResponseError):
+                    await message_store.publish_message("missing.1", Message("TheEvent", {}))
+            return await message_store.publish_message("category.1", Message("TheEvent", {}))
+
+        self.assertEqual(asyncio.run(run()).seq, 1)
+
+    def test_subscription_handles_and_acks_messages(self):
+        handled = []
+
+        async def run():
+            message_store = await create_message_store()
+            subscription = message_store.create_subscription(
+                "category.>",
+                "consumer",
+                handlers={"TheEvent": lambda msg: handled.append((msg.seq, msg.data))},
+            )
+            subscription.start()
+            await message_store.publish_message("category.1", Message("TheEvent", {"a": 1}))
+            await message_store.publish_message("category.2", Message("TheEvent", {"a": 2}))
+            await asyncio.sleep(0.05)
+            await message_store.close()
+            pull_subscription = await message_store._jetstream.pull_subscribe(
+                "test.category.>", durable="consumer"
+            )
+            return await pull_subscription.consumer_info()
+
+        consumer_info = asyncio.run(run())
+
+        self.assertEqual(handled, [(1, {"a": 1}), (2, {"a": 2})])
+        self.assertEqual(consumer_info.num_pending, 0)
+        self.assertEqual(consumer_info.num_ack_pending, 0)
+
+    def test_failing_message_is_redelivered_then_sent_to_dead_letter(self):
+        attempts = []
+
+        def failing_handler(msg):
+            attempts.append(msg.is_last_attempt)
+            raise Exception("boom")
+
+        async def run():
+            message_store = await create_message_store()
+            await message_store.ensure_stream("dead-letter")
+            subscription = message_store.create_subscription(
+                "category.>",
+                "consumer",
+                handlers={"TheEvent": failing_handler},
+                max_number_of_retries=3,
+                dead_letter_subject="dead-letter",
+            )
+            subscription.start()
+            await message_store.publish_message("category.1", Message("TheEvent", {}))
+            await asyncio.sleep(0.1)
+            await message_store.close()
+            return await message_store.fetch(
+                "dead-letter.>",
+                Projection(init=lambda: [], handlers={"TheEvent": lambda s, m: s + [m.subject]}),
+            )
+
+        dead_letters = asyncio.run(run())
+
+        self.assertEqual(attempts, [False, False, True])
+        self.assertEqual(dead_letters, ["dead-letter.category.1"])
+
+    def test_unacked_message_is_redelivered_after_ack_wait(self):
+        deliveries = []
+
+        async def run():
+            backend = InMemoryBackend(InMemoryServer(ack_wait_in_secs=0.05))
+            message_store = await create_message_store(backend)
+            await message_store.publish_message("category.1", Message("TheEvent", {}))
+            pull_subscription = await backend.jetstream().pull_subscribe(
+                "test.category.>", durable="consumer"
+            )
+            for _ in range(2):
+                message = (await pull_subscription.fetch(batch=1, timeout=1))[0]
+                deliveries.append(message.metadata.num_delivered)
+            await message.ack()
+            return await pull_subscription.consumer_info()
+
+        consumer_info = asyncio.run(run())
+
+        self.assertEqual(deliveries, [1, 2])
+        self.assertEqual(consumer_info.num_ack_pending, 0)
+
+    def test_message_nakked_with_a_delay_is_redelivered_once_it_passed(self):
+        async def run():
+            backend = InMemoryBackend()
+            message_store = await create_message_store(backend)
+            await message_store.publish_message("category.1", Message("TheEvent", {}))
+            pull_subscription = await backend.jetstream().pull_subscribe(
+                "test.category.>", durable="consumer"
+            )
+            message = (await pull_subscription.fetch(batch=1, timeout=1))[0]
+            await message.nak(delay=0.2)
+            with self.assertRaises(nats.errors.TimeoutError):
+                await pull_subscription.fetch(batch=1, timeout=0.05)
+            message = (await pull_subscription.fetch(batch=1, timeout=1))[0]
+            return message.metadata.num_delivered
+
+        self.assertEqual(asyncio.run(run()), 2)
+
+    def test_push_subscriptions_must_be_ordered(self):
+        async def run():
+            backend = InMemoryBackend()
+            await create_message_store(backend)
+            await backend.jetstream().subscribe("test.category.>")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(run())
+
+    def test_wait_for_receives_published_message(self):
+        async def run():
+            message_store = await create_message_store()
+            waiting = asyncio.create_task(
+                message_store.wait_for("category.>", lambda m: m.data["a"] == 2)
+            )
+            await asyncio.sleep(0)
+            await message_store.publish_message("category.1", Message("TheEvent", {"a": 1}))
+            await message_store.publish_message("category.1", Message("TheEvent", {"a": 2}))
+            return await waiting
+
+        self.assertEqual(asyncio.run(run()).data, {"a": 2})
+
+    def test_idempotency_store_on_key_value_skips_processed_messages(self):
+        handled = []
+
+        async def run():
+            backend = InMemoryBackend()
+            message_store = await create_message_store(backend)
+            idempotency_store = JetStreamIdempotencyStore(
+                backend.jetstream(), bucket="processed", local_cache_size=1
+            )
+            await message_store.publish_message("category.1", Message("TheEvent", {}))
+            await message_store.publish_message("category.2", Message("TheEvent", {}))
+            # recreating the consumer replays the stream from the start
+            for _ in range(2):
+                subscription = message_store.create_subscription(
+                    "category.>",
+                    "consumer",
+                    handlers={"TheEvent": lambda msg: handled.append(msg.seq)},
+                    idempotency_store=idempotency_store,
+                )
+                subscription.start()
+                await asyncio.sleep(0.05)
+                await subscription.stop()
+                await backend.jetstream().delete_consumer("test-category", "consumer")
+
+        asyncio.run(run())
+
+        self.assertEqual(handled, [1, 2])
+
+    def test_pool_of_connections_shares_server_state(self):
+        async def run():
+            server = InMemoryServer()
+            pool = ConnectionPool([InMemoryBackend(server) for _ in range(3)])
+            message_store = await create_message_store(pool)
+            for _ in range(4):
+                await message_store.publish_message("category.1", Message("TheEvent", {}))
+            return await message_store.fetch(
+                "category.1",
+                Projection(init=lambda: 0, handlers={"TheEvent": lambda count, _: count + 1}),
+            )
+
+        self.assertEqual(asyncio.run(run()), 4)
+
+    def test_close_closes_connections_even_if_a_subscription_failed(self):
+        async def run():
+            pool = ConnectionPool([InMemoryBackend(InMemoryServer()) for _ in range(3)])
+            message_store = await create_message_store(pool)
+            message_store.create_subscription("missing.>", "consumer", handlers={}).start()
+            message_store.create_subscription("category.>", "consumer", handlers={}).start()
+            await asyncio.sleep(0.05)
+            await message_store.close(close_connections=True)
+            return pool
+
+        pool = asyncio.run(run())
+
+        self.assertTrue(all(connection.is_closed for connection in pool.connections))
+
+    def test_close_stops_managed_subscriptions_once_through_their_manager(self):
+        async def run():
+            pool = ConnectionPool([InMemoryBackend(InMemoryServer()) for _ in range(3)])
+            message_store = await create_message_store(pool)
+            subscription = message_store.create_subscription(
+                "category.>", "consumer", handlers={}
+            )
+            manager = message_store.create_subscription_manager()
+            manager.add_subscription(subscription)
+            manager.start()
+            await asyncio.sleep(0.05)
+            with mock.patch.object(
+                subscription, "stop", wraps=subscription.stop
+            ) as stop:
+                await message_store.close()
+            return pool, stop
+
+        pool, stop = asyncio.run(run())
+
+        stop.assert_not_called()
+        self.assertEqual(pool._subscriptions_per_connection, [0, 0, 0])
+
+    def test_subject_matches_wildcards(self):
+        self.assertTrue(subject_matches("a.>", "a.b.c"))
+        self.assertFalse(subject_matches("a.>", "a"))
+        self.assertTrue(subject_matches("a.*.c", "a.b.c"))
+        self.assertFalse(subject_matches("a.*", "a.b.c"))
+        self.assertTrue(subject_matches("a.b", "a.b"))
+
+
+async def create_message_store(backend=None):
+    message_store = MessageStore(
+        backend if backend is not None else InMemoryBackend(),
+        prefix="test",
+        should_create_missing_streams=True,
+    )
+    await message_store.ensure_stream("category")
+    return message_store
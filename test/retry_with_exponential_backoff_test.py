@@ -0,0 +1,145 @@
+import unittest
+import unittest.mock as mock
+import asyncio
+
+from message_store.retry_with_exponential_backoff import retry_with_exponential_backoff
+from message_store.circuit_breaker import CircuitBreaker
+from message_store.circuit_open_exception import CircuitOpenException
+
+
+class RetryWithExponentialBackoffTests(unittest.TestCase):
+    def test_retries_until_success(self):
+        fn = mock.AsyncMock(side_effect=[RetriableError(), RetriableError(), "result"])
+
+        result = asyncio.run(retry(fn, max_retries=3))
+
+        self.assertEqual(result, "result")
+        self.assertEqual(fn.await_count, 3)
+
+    def test_non_retriable_error_is_raised_immediately(self):
+        fn = mock.AsyncMock(side_effect=ValueError())
+
+        with self.assertRaises(ValueError):
+            asyncio.run(retry(fn, max_retries=3))
+        self.assertEqual(fn.await_count, 1)
+
+    def test_jittered_backoff_waits_at_most_the_backoff_time(self):
+        fn = mock.AsyncMock(side_effect=[RetriableError()] * 4 + ["result"])
+
+        with mock.patch("asyncio.sleep", new_callable=mock.AsyncMock) as sleep_mock:
+            asyncio.run(retry(fn, max_retries=5, initial_backoff_time_in_seconds=1))
+
+        waits = [call.args[0] for call in sleep_mock.await_args_list]
+        self.assertEqual(len(waits), 4)
+        for wait, backoff in zip(waits, [1, 2, 4, 8]):
+            self.assertTrue(0 <= wait <= backoff)
+
+    def test_backoff_without_jitter_is_capped_by_max_backoff(self):
+        fn = mock.AsyncMock(side_effect=[RetriableError()] * 4 + ["result"])
+
+        with mock.patch("asyncio.sleep", new_callable=mock.AsyncMock) as sleep_mock:
+            asyncio.run(
+                retry(
+                    fn,
+                    max_retries=5,
+                    initial_backoff_time_in_seconds=1,
+                    max_backoff_time_in_seconds=3,
+                    jitter=False,
+                )
+            )
+
+        self.assertEqual(
+            [call.args[0] for call in sleep_mock.await_args_list], [1, 2, 3, 3]
+        )
+
+    def test_does_not_retry_past_the_deadline(self):
+        fn = mock.AsyncMock(side_effect=RetriableError())
+
+        with self.assertRaises(RetriableError):
+            asyncio.run(
+                retry(
+                    fn,
+                    max_retries=5,
+                    initial_backoff_time_in_seconds=10,
+                    jitter=False,
+                    deadline_in_seconds=1,
+                )
+            )
+        self.assertEqual(fn.await_count, 1)
+
+    def test_slow_first_attempt_succeeds_past_the_deadline(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1)
+
+        async def fn():
+            await asyncio.sleep(0.1)
+            return "result"
+
+        async def run():
+            return [
+                await retry_with_exponential_backoff(
+                    fn,
+                    is_retriable=lambda e: isinstance(e, asyncio.TimeoutError),
+                    deadline_in_seconds=0.01,
+                    circuit_breaker=circuit_breaker,
+                )
+                for _ in range(2)
+            ]
+
+        self.assertEqual(asyncio.run(run()), ["result", "result"])
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_circuit_fails_fast_without_calling_fn(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2)
+        fn = mock.AsyncMock(side_effect=RetriableError())
+
+        for _ in range(2):
+            with self.assertRaises(RetriableError):
+                asyncio.run(retry(fn, max_retries=3, circuit_breaker=circuit_breaker))
+        self.assertEqual(fn.await_count, 6)
+
+        with self.assertRaises(CircuitOpenException):
+            asyncio.run(retry(fn, max_retries=3, circuit_breaker=circuit_breaker))
+        self.assertEqual(fn.await_count, 6)
+
+    def test_exhausted_retries_count_as_a_single_failure(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2)
+        fn = mock.AsyncMock(side_effect=RetriableError())
+
+        with self.assertRaises(RetriableError):
+            asyncio.run(retry(fn, max_retries=5, circuit_breaker=circuit_breaker))
+
+        self.assertEqual(fn.await_count, 5)
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_opening_while_retrying_raises_the_original_error(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1)
+
+        async def fn():
+            # another call gives up in the meantime and opens the circuit
+            circuit_breaker.record_failure(is_probe=False)
+            raise RetriableError()
+
+        with self.assertRaises(RetriableError):
+            asyncio.run(
+                retry_with_exponential_backoff(
+                    fn,
+                    is_retriable=lambda e: isinstance(e, RetriableError),
+                    max_retries=5,
+                    initial_backoff_time_in_seconds=0.001,
+                    circuit_breaker=circuit_breaker,
+                )
+            )
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+
+async def retry(fn, initial_backoff_time_in_seconds=0.001, **kwargs):
+    return await retry_with_exponential_backoff(
+        lambda: fn(),
+        is_retriable=lambda e: isinstance(e, RetriableError),
+        initial_backoff_time_in_seconds=initial_backoff_time_in_seconds,
+        **kwargs,
+    )
+
+
+class RetriableError(Exception):
+    pass
@@ -0,0 +1,158 @@
+import unittest
+import unittest.mock as mock
+import asyncio
+
+import nats.errors
+
+from message_store.subscriptions.subscription_manager import SubscriptionManager
+from subscription_test import (
+    create_subscription,
+    create_pull_subscription_mock,
+    create_jetstream_message_mock,
+    create_pull_subscription_mock_with_late_message,
+)
+
+
+class SubscriptionManagerTests(unittest.TestCase):
+    def test_handles_messages_of_all_subscriptions(self):
+        handled = []
+        hot_subscription = create_subscription(
+            create_pull_subscription_mock(
+                messages=[create_jetstream_message_mock(seq=i) for i in range(1, 51)]
+            ),
+            handlers={"TheEvent": lambda msg: handled.append(("hot", msg.seq))},
+        )
+        quiet_subscription = create_subscription(
+            create_pull_subscription_mock(messages=[create_jetstream_message_mock(seq=1)]),
+            handlers={"TheEvent": lambda msg: handled.append(("quiet", msg.seq))},
+        )
+        manager = SubscriptionManager(poll_timeout_in_secs=0.01)
+        manager.add_subscription(hot_subscription)
+        manager.add_subscription(quiet_subscription)
+
+        asyncio.run(start_and_stop(manager))
+
+        self.assertEqual(len(handled), 51)
+        self.assertLess(handled.index(("quiet", 1)), 5)
+        self.assertEqual([seq for name, seq in handled if name == "hot"], list(range(1, 51)))
+
+    def test_weighted_subscriptions_are_polled_proportionally(self):
+        handled = []
+        manager = SubscriptionManager(max_concurrency=1)
+        for name, weight in [("a", 3), ("b", 1)]:
+            manager.add_subscription(
+                create_subscription(
+                    create_pull_subscription_mock(
+                        messages=[create_jetstream_message_mock(seq=i) for i in range(1, 21)]
+                    ),
+                    handlers={"TheEvent": lambda msg, name=name: handled.append(name)},
+                ),
+                weight=weight,
+            )
+
+        asyncio.run(start_and_stop(manager))
+
+        self.assertEqual(handled[:8], ["a", "a", "b", "a"] * 2)
+
+    def test_idle_subscriptions_are_backed_off(self):
+        pull_subscription = create_pull_subscription_mock(messages=[])
+        fetch = mock.Mock(wraps=pull_subscription.fetch)
+        pull_subscription.fetch = fetch
+        manager = SubscriptionManager(
+            poll_timeout_in_secs=0.01, max_idle_poll_interval_in_secs=0.08
+        )
+        manager.add_subscription(create_subscription(pull_subscription, handlers={}))
+
+        asyncio.run(start_and_stop(manager, wait_in_secs=0.5))
+
+        self.assertLess(fetch.call_count, 12)
+
+    def test_polls_reserve_the_in_flight_bytes_budget_before_fetching(self):
+        concurrent_fetches = []
+        max_concurrent_fetches = []
+
+        async def fetch(batch, timeout):
+            concurrent_fetches.append(None)
+            max_concurrent_fetches.append(len(concurrent_fetches))
+            try:
+                await asyncio.sleep(timeout)
+            finally:
+                concurrent_fetches.pop()
+            raise nats.errors.TimeoutError
+
+        manager = SubscriptionManager(
+            max_concurrency=10,
+            max_in_flight_bytes=200,
+            max_message_size_in_bytes=100,
+            poll_timeout_in_secs=0.05,
+        )
+        for _ in range(4):
+            manager.add_subscription(
+                create_subscription(
+                    mock.Mock(fetch=fetch, pending_msgs=0, unsubscribe=mock.AsyncMock()),
+                    handlers={},
+                )
+            )
+
+        asyncio.run(start_and_stop(manager))
+
+        self.assertEqual(max(max_concurrent_fetches), 2)
+        self.assertEqual(manager._in_flight_bytes, 0)
+
+    def test_stop_naks_message_delivered_for_cancelled_poll(self):
+        late_message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock_with_late_message(late_message)
+        manager = SubscriptionManager(poll_timeout_in_secs=5)
+        manager.add_subscription(create_subscription(pull_subscription, handlers={}))
+
+        asyncio.run(start_and_stop(manager, wait_in_secs=0.05))
+
+        pull_subscription.unsubscribe.assert_awaited_once()
+        late_message.nak.assert_awaited_once()
+
+    def test_stop_unsubscribes_and_releases_every_subscription(self):
+        pull_subscriptions = [create_pull_subscription_mock(messages=[]) for _ in range(2)]
+        release_connections = [mock.Mock() for _ in range(2)]
+        manager = SubscriptionManager(poll_timeout_in_secs=0.01)
+        for pull_subscription, release_connection in zip(pull_subscriptions, release_connections):
+            manager.add_subscription(
+                create_subscription(
+                    pull_subscription, handlers={}, release_connection=release_connection
+                )
+            )
+
+        asyncio.run(start_and_stop(manager, wait_in_secs=0.05))
+
+        for pull_subscription, release_connection in zip(pull_subscriptions, release_connections):
+            pull_subscription.unsubscribe.assert_awaited_once()
+            release_connection.assert_called_once()
+
+    def test_health_reports_pending_messages_per_subscription(self):
+        pull_subscription = create_pull_subscription_mock(
+            messages=[create_jetstream_message_mock()]
+        )
+        pull_subscription.consumer_info = mock.AsyncMock(
+            return_value=mock.Mock(num_pending=7, num_ack_pending=0)
+        )
+        manager = SubscriptionManager(poll_timeout_in_secs=0.01)
+        manager.add_subscription(create_subscription(pull_subscription, handlers={}))
+
+        async def run():
+            manager.start()
+            await asyncio.sleep(0.05)
+            health = await manager.get_health()
+            await manager.stop()
+            return health
+
+        health = asyncio.run(run())
+
+        self.assertEqual(len(health), 1)
+        self.assertEqual(health[0].num_pending, 7)
+        self.assertEqual(health[0].messages_handled, 1)
+        self.assertEqual(health[0].consumer_name, "consumer")
+
+
+async def start_and_stop(manager, wait_in_secs=0.2):
+    manager.start()
+    await asyncio.sleep(wait_in_secs)
+    await manager.stop()
@@ -0,0 +1,357 @@
+import unittest
+import unittest.mock as mock
+from message_store.subscriptions.subscription import Subscription
+from message_store.subscriptions.idempotency_store import InMemoryIdempotencyStore
+from message_store.subscriptions.executor_handler import (
+    ExecutorHandler,
+    run_handler_in_executor,
+)
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import nats.errors
+
+
+class SubscriptionStopTests(unittest.TestCase):
+    def test_stop_does_not_wait_for_pull_timeout(self):
+        pull_subscription = create_pull_subscription_mock(messages=[])
+        subscription = create_subscription(pull_subscription, handlers={})
+
+        async def run():
+            subscription.start()
+            await asyncio.sleep(0.05)
+            started_stopping_at = time.monotonic()
+            await subscription.stop()
+            return time.monotonic() - started_stopping_at
+
+        self.assertLess(asyncio.run(run()), 1)
+
+    def test_stop_waits_for_handler_in_progress(self):
+        message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock(messages=[message])
+        handled = []
+
+        async def handler(msg):
+            await asyncio.sleep(0.1)
+            handled.append(msg.seq)
+
+        subscription = create_subscription(
+            pull_subscription, handlers={"TheEvent": handler}
+        )
+
+        async def run():
+            subscription.start()
+            await asyncio.sleep(0.05)
+            await subscription.stop(drain_timeout_in_secs=5)
+
+        asyncio.run(run())
+
+        self.assertEqual(handled, [1])
+        message.ack.assert_awaited_once()
+        message.nak.assert_not_awaited()
+
+    def test_stop_with_drain_timeout_naks_handler_that_does_not_finish(self):
+        message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock(messages=[message])
+
+        async def handler(_):
+            await asyncio.sleep(60)
+
+        subscription = create_subscription(
+            pull_subscription, handlers={"TheEvent": handler}
+        )
+
+        async def run():
+            subscription.start()
+            await asyncio.sleep(0.05)
+            await subscription.stop(drain_timeout_in_secs=0.1)
+
+        asyncio.run(run())
+
+        message.nak.assert_awaited_once()
+        message.ack.assert_not_awaited()
+
+    def test_stop_naks_message_delivered_for_abandoned_pull(self):
+        late_message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock_with_late_message(late_message)
+        subscription = create_subscription(pull_subscription, handlers={})
+
+        asyncio.run(start_and_stop(subscription))
+
+        pull_subscription.unsubscribe.assert_awaited_once()
+        late_message.nak.assert_awaited_once()
+        self.assertEqual(pull_subscription.pending_msgs, 0)
+
+
+class SubscriptionIdempotencyTests(unittest.TestCase):
+    def test_redelivered_message_is_acked_without_calling_handler(self):
+        first_delivery = create_jetstream_message_mock(seq=1)
+        redelivery = create_jetstream_message_mock(seq=1)
+        pull_subscription = create_pull_subscription_mock(
+            messages=[first_delivery, redelivery]
+        )
+        handler = mock.Mock()
+        subscription = create_subscription(
+            pull_subscription,
+            handlers={"TheEvent": handler},
+            idempotency_store=InMemoryIdempotencyStore(),
+        )
+
+        asyncio.run(start_and_stop(subscription))
+
+        handler.assert_called_once()
+        first_delivery.ack.assert_awaited_once()
+        redelivery.ack.assert_awaited_once()
+
+    def test_messages_with_same_msg_id_are_handled_once(self):
+        pull_subscription = create_pull_subscription_mock(
+            messages=[
+                create_jetstream_message_mock(seq=1, headers={"Nats-Msg-Id": "a"}),
+                create_jetstream_message_mock(seq=2, headers={"Nats-Msg-Id": "a"}),
+                create_jetstream_message_mock(seq=3, headers={"Nats-Msg-Id": "b"}),
+            ]
+        )
+        handler = mock.Mock()
+        subscription = create_subscription(
+            pull_subscription,
+            handlers={"TheEvent": handler},
+            idempotency_store=InMemoryIdempotencyStore(),
+        )
+
+        asyncio.run(start_and_stop(subscription))
+
+        self.assertEqual([c.args[0].seq for c in handler.call_args_list], [1, 3])
+
+    def test_failed_handler_is_not_marked_as_processed(self):
+        first_delivery = create_jetstream_message_mock(seq=1)
+        redelivery = create_jetstream_message_mock(seq=1)
+        pull_subscription = create_pull_subscription_mock(
+            messages=[first_delivery, redelivery]
+        )
+        handler = mock.Mock(side_effect=[Exception("boom"), None])
+        subscription = create_subscription(
+            pull_subscription,
+            handlers={"TheEvent": handler},
+            idempotency_store=InMemoryIdempotencyStore(),
+        )
+
+        asyncio.run(start_and_stop(subscription))
+
+        self.assertEqual(handler.call_count, 2)
+        first_delivery.nak.assert_awaited_once()
+        redelivery.ack.assert_awaited_once()
+
+    def test_processed_message_redelivered_too_many_times_is_acked(self):
+        redelivery = create_jetstream_message_mock(seq=1)
+        redelivery.metadata.num_delivered = 10
+        pull_subscription = create_pull_subscription_mock(messages=[redelivery])
+        idempotency_store = InMemoryIdempotencyStore()
+        subscription = create_subscription(
+            pull_subscription,
+            handlers={"TheEvent": mock.Mock()},
+            idempotency_store=idempotency_store,
+        )
+
+        async def run():
+            await idempotency_store.mark_as_processed(
+                subscription._get_idempotency_key(redelivery)
+            )
+            await start_and_stop(subscription)
+
+        asyncio.run(run())
+
+        redelivery.ack.assert_awaited_once()
+        redelivery.term.assert_not_awaited()
+
+    def test_in_memory_store_evicts_least_recently_used_keys(self):
+        store = InMemoryIdempotencyStore(max_size=2)
+
+        async def run():
+            await store.mark_as_processed("a")
+            await store.mark_as_processed("b")
+            await store.was_processed("a")
+            await store.mark_as_processed("c")
+            return [await store.was_processed(key) for key in ["a", "b", "c"]]
+
+        self.assertEqual(asyncio.run(run()), [True, False, True])
+
+
+class SubscriptionExecutorTests(unittest.TestCase):
+    def test_sync_handlers_run_in_subscription_executor(self):
+        message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock(messages=[message])
+        handler_threads = []
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            subscription = create_subscription(
+                pull_subscription,
+                handlers={"TheEvent": lambda _: handler_threads.append(threading.current_thread())},
+                executor=executor,
+            )
+            asyncio.run(start_and_stop(subscription))
+
+        self.assertEqual(len(handler_threads), 1)
+        self.assertIsNot(handler_threads[0], threading.main_thread())
+        message.ack.assert_awaited_once()
+
+    def test_stop_is_bounded_and_acks_executor_handler_once_it_finishes(self):
+        message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock(messages=[message])
+        handler_finished = threading.Event()
+
+        def handler(_):
+            time.sleep(0.5)
+            handler_finished.set()
+
+        async def run():
+            subscription.start()
+            await asyncio.sleep(0.05)
+            started_stopping_at = time.monotonic()
+            await subscription.stop(drain_timeout_in_secs=0.05)
+            stop_duration = time.monotonic() - started_stopping_at
+            was_nak_awaited_by_then = message.nak.await_count > 0
+            await asyncio.sleep(0.6)
+            return stop_duration, was_nak_awaited_by_then
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            subscription = create_subscription(
+                pull_subscription, handlers={"TheEvent": ExecutorHandler(handler, executor)}
+            )
+            stop_duration, was_nak_awaited_by_then = asyncio.run(run())
+
+        self.assertLess(stop_duration, 0.4)
+        self.assertFalse(was_nak_awaited_by_then)
+        self.assertTrue(handler_finished.is_set())
+        message.ack.assert_awaited_once()
+        message.nak.assert_not_awaited()
+
+    def test_cancellation_propagates_once_executor_handler_finishes(self):
+        handler_finished = threading.Event()
+
+        def handler(_):
+            time.sleep(0.1)
+            handler_finished.set()
+
+        async def run():
+            task = asyncio.create_task(
+                run_handler_in_executor(None, handler, mock.Mock())
+            )
+            await asyncio.sleep(0.02)
+            task.cancel()
+            await asyncio.wait({task})
+            return task
+
+        task = asyncio.run(run())
+
+        self.assertTrue(task.cancelled())
+        self.assertTrue(handler_finished.is_set())
+
+    def test_executor_handler_rejects_coroutine_functions(self):
+        async def handler(_):
+            pass
+
+        with self.assertRaises(TypeError):
+            ExecutorHandler(handler)
+
+    def test_process_pool_handler_can_mark_message_for_termination(self):
+        message = create_jetstream_message_mock()
+        pull_subscription = create_pull_subscription_mock(messages=[message])
+
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            subscription = create_subscription(
+                pull_subscription,
+                handlers={"TheEvent": ExecutorHandler(terminate_if_data_is_empty, executor)},
+            )
+            asyncio.run(start_and_stop(subscription))
+
+        message.term.assert_awaited_once()
+        message.ack.assert_not_awaited()
+
+
+def terminate_if_data_is_empty(message):
+    if message.data == {}:
+        message.mark_for_termination()
+
+
+async def start_and_stop(subscription):
+    subscription.start()
+    await asyncio.sleep(0.05)
+    await subscription.stop()
+
+
+def create_subscription(
+    pull_subscription,
+    handlers,
+    idempotency_store=None,
+    executor=None,
+    release_connection=None,
+):
+    jetstream_client = mock.Mock(
+        pull_subscribe=mock.AsyncMock(return_value=pull_subscription)
+    )
+    return Subscription(
+        mock.Mock(is_closed=False),
+        jetstream_client,
+        "prefix.",
+        "subject.>",
+        "consumer",
+        handlers,
+        idempotency_store=idempotency_store,
+        executor=executor,
+        release_connection=release_connection,
+    )
+
+
+def create_pull_subscription_mock(messages):
+    remaining_messages = list(messages)
+
+    async def fetch(batch, timeout):
+        if remaining_messages:
+            return [remaining_messages.pop(0)]
+        await asyncio.sleep(timeout)
+        raise nats.errors.TimeoutError
+
+    return mock.Mock(fetch=fetch, pending_msgs=0, unsubscribe=mock.AsyncMock())
+
+
+def create_pull_subscription_mock_with_late_message(late_message):
+    """ The pull request of a cancelled fetch outlives it and gets late_message """
+    pending_messages = []
+
+    async def fetch(batch, timeout):
+        if pending_messages:
+            return [pending_messages.pop(0)]
+        try:
+            await asyncio.sleep(timeout)
+        except asyncio.CancelledError:
+            pending_messages.append(late_message)
+            raise
+        raise nats.errors.TimeoutError
+
+    pull_subscription = mock.Mock(fetch=fetch, unsubscribe=mock.AsyncMock())
+    type(pull_subscription).pending_msgs = mock.PropertyMock(
+        side_effect=lambda: len(pending_messages)
+    )
+    return pull_subscription
+
+
+def create_jetstream_message_mock(seq=1, type="TheEvent", headers=None):
+    return mock.Mock(
+        subject="prefix.subject.1",
+        headers=headers,
+        data=json.dumps({"type": type, "data": {}}).encode(),
+        metadata=mock.Mock(
+            stream="prefix-subject",
+            sequence=mock.Mock(stream=seq),
+            num_delivered=1,
+            timestamp=datetime.now(),
+        ),
+        ack=mock.AsyncMock(),
+        nak=mock.AsyncMock(),
+        term=mock.AsyncMock(),
+        in_progress=mock.AsyncMock(),
+    )